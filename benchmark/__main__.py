@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for Salsa API and service against a local fake upstream
+For details run: python -m benchmark -h
+"""
+
+from benchmark.upstream import FakeUpstream, patch_salsa
+from benchmark import bench
+from tempfile import TemporaryDirectory
+from datetime import datetime
+from json import dumps
+from time import time
+import argparse
+import platform
+from salsa import salsa as api
+import salsa
+import os
+
+
+parser = argparse.ArgumentParser(description='Salsa benchmarks')
+parser.add_argument('benchmarks',
+                    type=str,
+                    nargs='*',
+                    default=['cli', 'api', 'controller'],
+                    help='Benchmarks to run: [cli, api, controller].')
+parser.add_argument('-o', '--output',
+                    action='store',
+                    type=str,
+                    default=None,
+                    help='JSON results file, default stdout.')
+parser.add_argument('-l', '--latency',
+                    action='store',
+                    type=float,
+                    default=0.05,
+                    help='Fake upstream latency in seconds.')
+parser.add_argument('-f', '--failure-rate',
+                    action='store',
+                    type=float,
+                    default=0.0,
+                    help='Fake upstream failure rate 0..1.')
+parser.add_argument('-r', '--requests',
+                    action='store',
+                    type=int,
+                    default=2000,
+                    help='Requests per API route.')
+parser.add_argument('-c', '--concurrency',
+                    action='store',
+                    type=int,
+                    default=16,
+                    help='Concurrent API clients.')
+parser.add_argument('--runs',
+                    action='store',
+                    type=int,
+                    default=5,
+                    help='Runs per CLI command.')
+parser.add_argument('--duration',
+                    action='store',
+                    type=float,
+                    default=20,
+                    help='Schedule controller run time in seconds.')
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    results = {'version': salsa.__version__,
+               'python': platform.python_version(),
+               'timestamp': datetime.now().astimezone(tz=None).isoformat(),
+               'upstream': {'latency': args.latency, 'failure_rate': args.failure_rate}}
+    with TemporaryDirectory(prefix='salsa-bench-') as work_dir:
+        if 'cli' in args.benchmarks or 'api' in args.benchmarks:
+            upstream = FakeUpstream(latency=args.latency, failure_rate=args.failure_rate).start()
+            try:
+                if 'cli' in args.benchmarks:
+                    results['cli'] = bench.bench_cli(upstream.url, work_dir, runs=args.runs)
+                if 'api' in args.benchmarks:
+                    results['api'] = bench.bench_api(upstream.url, work_dir,
+                                                     requests=args.requests, concurrency=args.concurrency)
+                results['upstream']['requests'] = upstream.requests
+            finally:
+                upstream.stop()
+        if 'controller' in args.benchmarks:
+            cwd = os.getcwd()
+            os.chdir(work_dir)
+            upstream = FakeUpstream(stage=1,
+                                    blocks=['1A', '1B'],
+                                    start=time() + 5,
+                                    slot_seconds=2,
+                                    duration_seconds=1,
+                                    days=(args.duration + 60) / (24 * 60 * 60),
+                                    latency=args.latency).start()
+            try:
+                patch_salsa(upstream.url)
+                results['controller'] = bench.bench_controller(upstream, duration=args.duration)
+            finally:
+                upstream.stop()
+                # work_dir is deleted before exit, nothing is left to snapshot there
+                api.schedule_cache.snapshot_file = api.stage_cache.snapshot_file = None
+                os.chdir(cwd)
+    output = dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
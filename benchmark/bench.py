@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+bench.py - CLI, HTTP API and schedule controller benchmarks against the fake upstream
+"""
+
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from datetime import datetime
+from pathlib import Path
+from json import dumps
+from time import monotonic, sleep, time
+import subprocess
+import socket
+import sys
+import os
+
+
+ROOT = str(Path(__file__).resolve().parent.parent)
+
+CLI_BOOTSTRAP = '''
+import sys, runpy
+from benchmark.upstream import patch_salsa
+patch_salsa(sys.argv.pop(1))
+runpy.run_module('salsa', run_name='__main__', alter_sys=True)
+'''
+
+SERVICE_BOOTSTRAP = '''
+import sys, runpy
+from benchmark.upstream import patch_salsa
+patch_salsa(sys.argv.pop(1))
+runpy.run_module('service', run_name='__main__', alter_sys=True)
+'''
+
+CLI_COMMANDS = {
+    'stage': ['stage'],
+    'list': ['list'],
+    'find': ['find', '-n', 'Suburb 1'],
+    'schedule': ['schedule', '-s', '2', '-b', '1A'],
+    'outages': ['outages', '-s', '4'],
+}
+
+API_ROUTES = {
+    'stage': '/api/stage',
+    'list': '/api/list',
+    'find': '/api/find?name=Suburb%201',
+    'schedule': '/api/schedule?stage=2&block=1A',
+    'outages': '/api/outages?stage=4',
+}
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summary(values: List[float]) -> Dict:
+    return {'count': len(values),
+            'mean': sum(values) / len(values) if values else None,
+            'p50': percentile(values, 50),
+            'p99': percentile(values, 99),
+            'max': max(values) if values else None}
+
+
+def env() -> Dict:
+    return {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')]))}
+
+
+def bench_cli(upstream_url: str, work_dir: str, runs: int = 5) -> Dict:
+    """ Wall time of python -m salsa commands, cold (no cache files) and warm. """
+    results = {}
+    for name, command in CLI_COMMANDS.items():
+        for state in ('cold', 'warm'):
+            timings = []
+            for _ in range(runs):
+                if state == 'cold':
+                    for cache_file in ('suburbs.json', 'schedules.json', 'stage.json'):
+                        Path(work_dir, cache_file).unlink(missing_ok=True)
+                start = monotonic()
+                subprocess.run([sys.executable, '-c', CLI_BOOTSTRAP, upstream_url, *command],
+                               cwd=work_dir, env=env(), check=True, stdout=subprocess.DEVNULL)
+                timings.append(monotonic() - start)
+            results[f'{name}_{state}'] = summary(timings)
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            sleep(0.1)
+    raise TimeoutError(f'Service did not start on port {port}')
+
+
+def load(port: int, path: str, requests: int, concurrency: int) -> Dict:
+    """ Issue requests GETs on path over concurrency keep-alive connections. """
+    per_worker = max(1, requests // concurrency)
+
+    def worker(_) -> (List[float], int):
+        connection = HTTPConnection('127.0.0.1', port, timeout=30)
+        timings, errors = [], 0
+        for _ in range(per_worker):
+            start = monotonic()
+            try:
+                connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    errors += 1
+            except (OSError, Exception):
+                errors += 1
+                connection.close()
+                connection = HTTPConnection('127.0.0.1', port, timeout=30)
+            timings.append(monotonic() - start)
+        connection.close()
+        return timings, errors
+
+    start = monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(worker, range(concurrency)))
+    elapsed = monotonic() - start
+    timings = [t for r in results for t in r[0]]
+    return {**summary(timings),
+            'concurrency': concurrency,
+            'errors': sum(r[1] for r in results),
+            'throughput': len(timings) / elapsed}
+
+
+def bench_api(upstream_url: str, work_dir: str, requests: int = 2000, concurrency: int = 16) -> Dict:
+    """ Throughput and latency of /api/* routes of a service started with start_server. """
+    port = free_port()
+    config = Path(work_dir, 'bench_config.json')
+    config.write_text(dumps({'salsa': {'block': '1A', 'prefetch': True},
+                             'server': {'port': port},
+                             'logging': {'level': 'WARNING', 'file': str(Path(work_dir, 'service.log'))}}))
+    process = subprocess.Popen([sys.executable, '-c', SERVICE_BOOTSTRAP, upstream_url,
+                                '-c', str(config), '-p', str(port)],
+                               cwd=work_dir, env=env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        results = {}
+        for name, path in API_ROUTES.items():
+            load(port, path, concurrency, concurrency)
+            results[name] = load(port, path, requests, concurrency)
+        return results
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+class RecordingClient(object):
+    """ MQTT client stand-in recording publish times, acknowledges every message immediately. """
+
+    class MessageInfo(object):
+        def __init__(self, mid):
+            self.mid = mid
+            self.rc = 0
+
+    def __init__(self):
+        self.on_message = None
+        self.on_publish = None
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((time(), topic, payload))
+        info = RecordingClient.MessageInfo(len(self.published))
+        if self.on_publish:
+            self.on_publish(self, None, info.mid)
+        return info
+
+
+def bench_controller(upstream, block: str = '1A', duration: float = 20) -> Dict:
+    """ Lateness of POWER_OUTAGE_NOW/OFF alerts fired by ScheduleController against the schedule. """
+    from service.schedule_controller import ScheduleController, ALERT_POWER_OUTAGE_NOW, ALERT_ROWER_OUTAGE_OFF
+    from service.utils import Config
+    from service.mqtt import Notifier
+    from salsa import salsa
+    from json import loads
+
+    config = Config.__new__(Config)
+    config._config = {'salsa': {'block': block, 'interval': 5}, 'mqtt': {'topic': 'bench'}}
+    client = RecordingClient()
+    controller = ScheduleController(config, Notifier(client, config))
+    controller.start()
+    sleep(duration)
+    controller.stop()
+
+    now = datetime.now().astimezone(tz=None)
+    schedule = salsa.get_schedule(upstream.stage, block=block, days=2)['schedule']
+    expected = {ALERT_POWER_OUTAGE_NOW: [s['start'].timestamp() for s in schedule],
+                ALERT_ROWER_OUTAGE_OFF: [s['end'].timestamp() for s in schedule]}
+    fired = {}
+    for published_at, topic, payload in client.published:
+        if topic.endswith('/alert') and (alert := loads(payload)['alert']) in expected:
+            fired.setdefault(alert, []).append(published_at)
+    lateness, missed = [], 0
+    started = now.timestamp() - duration
+    for alert, times in expected.items():
+        due = sorted(t for t in times if started < t <= now.timestamp())
+        actual = sorted(fired.get(alert, []))
+        missed += max(0, len(due) - len(actual))
+        lateness.extend(a - d for d, a in zip(due, actual))
+    return {**summary(lateness), 'missed': missed}
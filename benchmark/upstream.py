@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+upstream.py - Local stand-in for the Eskom GetStatus and CityPower OData APIs
+"""
+
+from typing import Dict, List
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, quote
+from threading import Thread
+from datetime import datetime, timezone
+from json import dumps
+from random import random
+from time import sleep
+from salsa import salsa
+import re
+
+
+ESKOM_HOST = 'http://loadshedding.eskom.co.za'
+CITYPOWER_HOST = 'https://www.citypower.co.za'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def make_blocks(numbers: int = 16, letters: str = 'ABCD') -> List[str]:
+    return [f'{n}{l}' for n in range(1, numbers + 1) for l in letters]
+
+
+class FakeUpstream(object):
+    """
+    Serves GetStatus, LoadSheddingSuburb and Loadshedding with configurable latency and failure rate.
+    The schedule is a fixed rotation: slot i starts at start + i * slot_seconds and switches off
+    stage consecutive blocks, so the table of stage n covers n times as many block slots as stage 1.
+    """
+
+    def __init__(self,
+                 stage: int = 2,
+                 blocks: List[str] = None,
+                 suburbs_per_block: int = 30,
+                 start: float = None,
+                 slot_seconds: int = 2 * 60 * 60,
+                 duration_seconds: int = 2 * 60 * 60 + 30 * 60,
+                 days: int = 7,
+                 page_size: int = 500,
+                 latency: float = 0.0,
+                 failure_rate: float = 0.0,
+                 port: int = 0):
+        self.stage = stage
+        self.blocks = blocks or make_blocks()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.page_size = page_size
+        self.requests = 0
+        self.suburbs = [{'ID': i,
+                         'Title': f'Suburb {i}',
+                         'SubBlock': {'Title': self.blocks[i % len(self.blocks)]}}
+                        for i in range(len(self.blocks) * suburbs_per_block)]
+        if start is None:
+            start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        slots = int(days * 24 * 60 * 60 / slot_seconds)
+        self.schedules = {stage: self._rotation(stage, start, slots, slot_seconds, duration_seconds)
+                          for stage in range(1, 9)}
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._thread = None
+
+    def _rotation(self, stage: int, start: float, slots: int, slot_seconds: int, duration: int) -> List[Dict]:
+        records = []
+        for i in range(slots):
+            slot_start = start + i * slot_seconds
+            blocks = [self.blocks[(i * stage + k) % len(self.blocks)] for k in range(stage)]
+            records.append({'ID': len(records),
+                            'Title': f'Stage{stage}',
+                            'SubBlock': ','.join(blocks),
+                            'EventDate': datetime.fromtimestamp(slot_start, timezone.utc).strftime(DATE_FORMAT),
+                            'EndDate': datetime.fromtimestamp(slot_start + duration, timezone.utc)
+                           .strftime(DATE_FORMAT)})
+        return records
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def _respond(self, path: str, query: Dict) -> (int, object):
+        if path.endswith('/GetStatus'):
+            return 200, self.stage + 1
+        if "'LoadSheddingSuburb'" in path:
+            return 200, {'d': {'results': self.suburbs}}
+        if "'Loadshedding'" in path:
+            odata_filter = query.get('$filter', [''])[0]
+            stage = int(re.search(r"Stage(\d+)", odata_filter).group(1))
+            records = self.schedules.get(stage, [])
+            if block := re.search(r"substringof\('([^']+)'", odata_filter):
+                return 200, {'d': {'results': [r for r in records if block.group(1) in r['SubBlock']]}}
+            skip = int(query.get('$skip', ['0'])[0])
+            page = {'results': records[skip:skip + self.page_size]}
+            if skip + self.page_size < len(records):
+                next_filter = quote(odata_filter, safe="'()")
+                page['__next'] = f'{self.url}{path}?$filter={next_filter}&$skip={skip + self.page_size}'
+            return 200, {'d': page}
+        return 404, {'error': path}
+
+    def _handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                upstream.requests += 1
+                if upstream.latency:
+                    sleep(upstream.latency)
+                if random() < upstream.failure_rate:
+                    status, data = 503, {'error': 'injected failure'}
+                else:
+                    parts = urlsplit(self.path)
+                    status, data = upstream._respond(parts.path, parse_qs(parts.query))
+                body = dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self) -> 'FakeUpstream':
+        self._thread = Thread(target=self._server.serve_forever, name='Fake upstream', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def patch_salsa(url: str):
+    """ Point salsa API_GET_* at the fake upstream at url. """
+    for name in ('API_GET_STATUS', 'API_GET_SUBURBS', 'API_GET_SCHEDULE', 'API_GET_STAGE_SCHEDULE'):
+        setattr(salsa, name, getattr(salsa, name).replace(ESKOM_HOST, url).replace(CITYPOWER_HOST, url))
@@ -7,7 +7,9 @@ For details run: python -m salsa -h
 
 import argparse
 import sys
+from datetime import datetime
 from salsa import salsa
+from salsa.batch import BatchRunner
 
 
 sys.tracebacklimit = 0
@@ -20,7 +22,8 @@ parser.add_argument('-v', '--version',
                     help='Print current API version.')
 parser.add_argument('command',
                     type=str,
-                    help='API command: [stage, list, find, schedule].')
+                    help='API command: [stage, list, find, suggest, schedule, prefetch, outages, compile, '
+                         'rotation, batch].')
 parser.add_argument('-n', '--name',
                     action='store',
                     metavar='SUBURB-NAME',
@@ -32,9 +35,9 @@ parser.add_argument('-s', '--stage',
                     action='store',
                     metavar='STAGE',
                     type=int,
-                    default=1,
-                    choices=range(1, 5),
-                    help='Stage parameter for schedule.')
+                    default=None,
+                    choices=salsa.PREFETCH_STAGES,
+                    help='Stage parameter for schedule and prefetch.')
 parser.add_argument('-d', '--days',
                     action='store',
                     metavar='COUNT',
@@ -47,14 +50,56 @@ parser.add_argument('-b', '--block',
                     type=str,
                     default=None,
                     help='Block ID for suburb and schedule query.')
+parser.add_argument('-l', '--limit',
+                    action='store',
+                    metavar='COUNT',
+                    type=int,
+                    default=10,
+                    help='Maximum number of suggestions.')
+parser.add_argument('-a', '--at',
+                    action='store',
+                    metavar='ISO-DATETIME',
+                    type=datetime.fromisoformat,
+                    default=None,
+                    help='Time for outages query, default now.')
+parser.add_argument('--snapshot',
+                    action='store',
+                    metavar='FILE',
+                    type=str,
+                    default=salsa.SNAPSHOT_FILE,
+                    help='Snapshot file written by compile and read in offline mode.')
+parser.add_argument('-o', '--offline',
+                    action='store_true',
+                    help='Answer queries from snapshot file without upstream requests.')
+parser.add_argument('-r', '--rotation',
+                    action='store_true',
+                    help='Project schedules from the rotation file, learned first if it does not exist.')
+parser.add_argument('--rotation-file',
+                    action='store',
+                    metavar='FILE',
+                    type=str,
+                    default=salsa.ROTATION_FILE,
+                    help='Rotation file written by rotation and read with -r.')
+parser.add_argument('-w', '--workers',
+                    action='store',
+                    metavar='COUNT',
+                    type=int,
+                    default=8,
+                    help='Concurrent queries in batch mode.')
 args = parser.parse_args()
 
 
 if __name__ == "__main__":
+    if args.offline:
+        salsa.use_snapshot(args.snapshot)
+    if args.rotation and args.command != 'rotation':
+        salsa.use_rotation(args.rotation_file)
     if cmd := args.command:
         if cmd == 'stage':
             stage = salsa.get_stage()
             print(f'Load shedding stage {stage}' if stage > 0 else "No load shedding")
+            if (age := salsa.get_stage_age()) is not None and age > salsa.stage_cache.ttl:
+                print(f'Last known stage from {age / 60:.0f} minutes ago, upstream unavailable')
         elif cmd == 'list':
             for suburb in salsa.get_suburbs():
                 print(f"{suburb['title']} - {suburb['block']}")
@@ -62,8 +107,11 @@ if __name__ == "__main__":
             for suburb in salsa.find_suburb(name=" ".join(args.name) if args.name else None,
                                             block=args.block):
                 print(f"{suburb['title']} - {suburb['block']}")
+        elif cmd == 'suggest':
+            for suburb in salsa.suggest_suburbs(" ".join(args.name) if args.name else None, limit=args.limit):
+                print(f"{suburb['title']} - {suburb['block']} ({suburb['score']:.2f})")
         elif cmd == 'schedule':
-            schedule = salsa.get_schedule(args.stage,
+            schedule = salsa.get_schedule(args.stage or 1,
                                           name=" ".join(args.name) if args.name else None,
                                           block=args.block,
                                           days=args.days)
@@ -71,5 +119,30 @@ if __name__ == "__main__":
             for s in schedule['schedule']:
                 print(f"  Start: {s['start']}")
                 print(f"  End:   {s['end']}")
+        elif cmd == 'prefetch':
+            for stage, count in salsa.prefetch([args.stage] if args.stage else salsa.PREFETCH_STAGES).items():
+                print(f'Stage {stage} - {count} blocks')
+        elif cmd == 'outages':
+            at = args.at.astimezone(tz=None) if args.at else None
+            outages = salsa.get_outages(args.stage or 1, at=at)
+            print(f'Stage {outages["stage"]} - {len(outages["outages"])} blocks off at {outages["from"]}')
+            for o in outages['outages']:
+                print(f"  {o['block']}: {o['start']} - {o['end']}")
+                print(f"    {', '.join(o['suburbs'])}")
+        elif cmd == 'compile':
+            for stage, count in salsa.compile_snapshot(args.snapshot,
+                                                       [args.stage] if args.stage else salsa.PREFETCH_STAGES).items():
+                print(f'Stage {stage} - {count} blocks')
+            print(f'Snapshot written to {args.snapshot}')
+        elif cmd == 'rotation':
+            table = salsa.learn_rotation(args.rotation_file,
+                                         [args.stage] if args.stage else salsa.PREFETCH_STAGES)
+            for stage in sorted({stage for stage, _ in table.rotations}):
+                periods = sorted({r.period for (s, _), r in table.rotations.items() if s == stage})
+                print(f'Stage {stage} - {sum(1 for s, _ in table.rotations if s == stage)} blocks, '
+                      f'period {", ".join(f"{p / 3600:g}h" for p in periods)}')
+            print(f'Rotation written to {args.rotation_file}' if table else 'No rotation learned.')
+        elif cmd == 'batch':
+            BatchRunner(sys.stdout, workers=args.workers).run(sys.stdin)
         else:
             print(f'Invalid command {cmd}.')
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+aio.py - Asyncio variant of the Salsa API
+
+Coroutines share the implementation and caches of salsa.salsa. This module is thread
+backed: upstream calls stay blocking and run on a bounded thread pool, so they do not
+block the event loop, but every upstream wait still occupies one pool thread. Fan-out
+helpers warm the cache with one bulk query first, so most coroutines then complete
+from the cache without an upstream wait.
+"""
+
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from salsa import salsa
+import asyncio
+
+
+MAX_WORKERS = 16
+CONCURRENCY = 8
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='salsa-aio')
+
+
+async def _run(function: Callable, *args, **kwargs) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(function, *args, **kwargs))
+
+
+async def gather_limited(aws: Iterable[Awaitable],
+                         limit: int = CONCURRENCY,
+                         return_exceptions: bool = False) -> List[Any]:
+    """ Like asyncio.gather, but runs at most limit awaitables at a time. """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(aw: Awaitable) -> Any:
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*[limited(aw) for aw in aws], return_exceptions=return_exceptions)
+
+
+async def get_stage(force_fetch: bool = False) -> int:
+    return await _run(salsa.get_stage, force_fetch)
+
+
+async def get_suburbs(force_fetch: bool = False) -> [Dict]:
+    return await _run(salsa.get_suburbs, force_fetch)
+
+
+async def find_suburb(name: str = None, block: str = None) -> [Dict]:
+    return await _run(salsa.find_suburb, name=name, block=block)
+
+
+async def suggest_suburbs(query: str, limit: int = salsa.DEFAULT_LIMIT) -> [Dict]:
+    return await _run(salsa.suggest_suburbs, query, limit)
+
+
+async def get_schedule(stage: int,
+                       name: str = None,
+                       block: str = None,
+                       from_date: datetime = None,
+                       days: int = 7) -> Dict:
+    return await _run(salsa.get_schedule, stage, name=name, block=block, from_date=from_date, days=days)
+
+
+async def get_schedules(queries: Iterable[Dict], from_date: datetime = None) -> [Dict]:
+    return await _run(salsa.get_schedules, list(queries), from_date=from_date)
+
+
+async def get_block_schedules(stage: int,
+                              blocks: Iterable[str],
+                              from_date: datetime = None,
+                              days: int = 7,
+                              limit: int = CONCURRENCY) -> List[Any]:
+    """ Schedules for many blocks of one stage. Failed queries are returned as exceptions. """
+    blocks = list(blocks)
+    # One bulk query for the stage instead of one upstream query per block
+    await _run(salsa.warm_schedules, stage, [block.upper() for block in blocks])
+    return await gather_limited([get_schedule(stage, block=block, from_date=from_date, days=days)
+                                 for block in blocks],
+                                limit=limit, return_exceptions=True)
+
+
+async def get_stage_schedules(name: str = None,
+                              block: str = None,
+                              stages: Iterable[int] = salsa.PREFETCH_STAGES,
+                              from_date: datetime = None,
+                              days: int = 7,
+                              limit: int = CONCURRENCY) -> List[Any]:
+    """ Schedules of one suburb or block for all stages. Failed queries are returned as exceptions. """
+    return await gather_limited([get_schedule(stage, name=name, block=block, from_date=from_date, days=days)
+                                 for stage in stages],
+                                limit=limit, return_exceptions=True)
+
+
+async def prefetch(stages: Iterable[int] = salsa.PREFETCH_STAGES, limit: int = CONCURRENCY) -> Dict[int, int]:
+    counts = await gather_limited([_run(salsa.prefetch, [stage]) for stage in stages], limit=limit)
+    return {stage: count for c in counts for stage, count in c.items()}
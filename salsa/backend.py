@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+backend.py - Cache backends shared between processes
+
+A backend stores JSON values with the time they were stored and grants a leader lease.
+Caches with a backend read values other processes stored there and only the leader
+loads from the upstream, followers read what the leader stored.
+  MemoryBackend - in one process, every caller is leader
+  SQLiteBackend - in a SQLite file shared by the processes on a host
+"""
+
+from typing import Any, Iterable, Tuple
+from threading import Lock, local
+from json import dumps, loads
+from socket import gethostname
+from os import getpid
+from time import time
+import sqlite3
+import logging
+
+
+LEADER_LEASE = 'leader'
+LEASE_TTL = 30  # in seconds
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, stored_at REAL);
+CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL);
+'''
+
+
+class MemoryBackend(object):
+    """ Backend in process memory. """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+
+    def get(self, key: str) -> Tuple[Any, float]:
+        """ (value, stored_at) of key, None if not stored. """
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: str, value: Any):
+        self.put_many([(key, value)])
+
+    def put_many(self, items: Iterable[Tuple[str, Any]]):
+        now = time()
+        with self._lock:
+            self._entries.update((key, (value, now)) for key, value in items)
+
+    def is_leader(self) -> bool:
+        return True
+
+
+class SQLiteBackend(object):
+    """
+    Backend in a SQLite file in WAL mode, readers do not block the writer.
+    The leader lease is held by one owner (host:pid) until it expires after lease_ttl seconds,
+    the leader renews it while it checks is_leader, then any process can take it over.
+    """
+
+    def __init__(self, path: str, lease_ttl: float = LEASE_TTL, owner: str = None):
+        self._local = local()
+        self._lease_lock = Lock()
+        self._lease = (False, 0.0)
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self.owner = owner or f'{gethostname()}:{getpid()}'
+        with self._connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        if (connection := getattr(self._local, 'connection', None)) is None:
+            connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Tuple[Any, float]:
+        """ (value, stored_at) of key, None if not stored. """
+        row = self._connection().execute('SELECT value, stored_at FROM entries WHERE key = ?', (key,)).fetchone()
+        return None if row is None else (loads(row[0]), row[1])
+
+    def put(self, key: str, value: Any):
+        self.put_many([(key, value)])
+
+    def put_many(self, items: Iterable[Tuple[str, Any]]):
+        now = time()
+        with self._connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                                   ((key, dumps(value), now) for key, value in items))
+
+    def is_leader(self) -> bool:
+        """ Acquire or renew the leader lease, True if this process holds it. """
+        with self._lease_lock:
+            leader, checked_at = self._lease
+            now = time()
+            # Check at most three times per lease, renewal is a write
+            if now - checked_at < self.lease_ttl / 3:
+                return leader
+            with self._connection() as connection:
+                connection.execute('INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE '
+                                   'SET owner = excluded.owner, expires = excluded.expires '
+                                   'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+                                   (LEADER_LEASE, self.owner, now + self.lease_ttl, now))
+                owner = connection.execute('SELECT owner FROM leases WHERE name = ?', (LEADER_LEASE,)).fetchone()[0]
+            if (owner == self.owner) != leader:
+                logging.info(f'{"Acquired" if owner == self.owner else "Lost"} {LEADER_LEASE} lease, '
+                             f'leader is {owner}.')
+            self._lease = (owner == self.owner, now)
+            return self._lease[0]
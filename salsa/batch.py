@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+batch.py - Streaming JSONL batch queries
+
+One query per input line, e.g.:
+  {"id": 1, "command": "find", "name": "rosebank"}
+  {"id": 2, "command": "schedule", "stage": 2, "block": "2A", "days": 3}
+  {"id": 3, "command": "stage"}
+  {"id": 4, "command": "outages", "stage": 4, "at": "2020-12-01T18:00"}
+  {"id": 5, "command": "suggest", "q": "roseback", "limit": 5}
+One result per output line, in completion order, with the query id and either result or error.
+"""
+
+from typing import Any, Dict, IO
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, BoundedSemaphore
+from datetime import datetime
+from json import dumps, loads
+from salsa import salsa
+
+
+WORKERS = 8
+
+
+def _schedule(query: Dict) -> Dict:
+    schedule = salsa.get_schedule(int(query['stage']),
+                                  name=query.get('name'),
+                                  block=query.get('block'),
+                                  days=int(query.get('days', 7)))
+    return {'block': schedule['block'],
+            'stage': schedule['stage'],
+            'age': schedule['age'],
+            'schedule': [{'start': s['start'].isoformat(), 'end': s['end'].isoformat()}
+                         for s in schedule['schedule']]}
+
+
+def _outages(query: Dict) -> Dict:
+    at = datetime.fromisoformat(query['at']).astimezone(tz=None) if query.get('at') else None
+    until = datetime.fromisoformat(query['until']).astimezone(tz=None) if query.get('until') else None
+    outages = salsa.get_outages(int(query['stage']), at=at, until=until)
+    return {'stage': outages['stage'],
+            'from': outages['from'].isoformat(),
+            'to': outages['to'].isoformat(),
+            'outages': [{**o, 'start': o['start'].isoformat(), 'end': o['end'].isoformat()}
+                        for o in outages['outages']]}
+
+
+COMMANDS = {
+    'stage': lambda query: salsa.get_stage(),
+    'find': lambda query: salsa.find_suburb(name=query.get('name'), block=query.get('block')),
+    'suggest': lambda query: salsa.suggest_suburbs(query.get('q'), limit=int(query.get('limit', 10))),
+    'schedule': _schedule,
+    'outages': _outages,
+}
+
+
+class BatchRunner(object):
+    """ Runs queries on a bounded thread pool, sharing salsa's suburb index and caches. """
+
+    def __init__(self, output: IO, workers: int = WORKERS):
+        self._output = output
+        self._output_lock = Lock()
+        self._workers = workers
+        self._in_flight = BoundedSemaphore(workers * 2)
+        self._warm_lock = Lock()
+        self._warm_stages = set()
+
+    def _warm(self, stage: int):
+        # First schedule query of a stage loads all blocks with one bulk query
+        with self._warm_lock:
+            if stage not in self._warm_stages:
+                self._warm_stages.add(stage)
+                salsa.warm_schedules(stage, salsa.suburb_index.blocks)
+
+    def _write(self, result: Dict):
+        line = dumps(result)
+        with self._output_lock:
+            self._output.write(line + '\n')
+            self._output.flush()
+
+    def _run(self, query: Any):
+        try:
+            if not isinstance(query, dict):
+                raise ValueError('Query must be a JSON object')
+            if (command := COMMANDS.get(query.get('command'))) is None:
+                raise ValueError(f'Invalid command {query.get("command")}')
+            if query.get('command') == 'schedule' and 'stage' in query:
+                self._warm(int(query['stage']))
+            result = {'id': query.get('id'), 'result': command(query)}
+        except Exception as e:
+            result = {'id': query.get('id') if isinstance(query, dict) else None, 'error': str(e)}
+        finally:
+            self._in_flight.release()
+        self._write(result)
+
+    def run(self, lines: IO) -> int:
+        """ Read queries from lines until EOF and stream results. Returns number of queries. """
+        count = 0
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='salsa-batch') as executor:
+            for line in lines:
+                if not (line := line.strip()):
+                    continue
+                count += 1
+                try:
+                    query = loads(line)
+                except ValueError as e:
+                    self._write({'id': None, 'error': f'Invalid JSON: {e}'})
+                    continue
+                self._in_flight.acquire()
+                executor.submit(self._run, query)
+        return count
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+breaker.py - Circuit breaker for upstream calls
+"""
+
+from threading import Lock
+from time import monotonic
+from salsa.metrics import upstream_circuit
+import logging
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker(object):
+    """
+    Opens after failure_threshold consecutive failures, so callers fail fast instead of waiting
+    for timeouts. While open, a single probe call is let through after reset_timeout seconds,
+    the timeout doubles after every failed probe up to max_reset_timeout. A successful call closes it.
+    """
+
+    def __init__(self,
+                 name: str,
+                 failure_threshold: int = 3,
+                 reset_timeout: float = 15,
+                 max_reset_timeout: float = 300):
+        self._lock = Lock()
+        self._failures = 0
+        self._state = CLOSED
+        self._timeout = reset_timeout
+        self._probe_at = None
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        upstream_circuit.set(STATE_VALUES[CLOSED], host=name)
+
+    def _set_state(self, state: str):
+        self._state = state
+        upstream_circuit.set(STATE_VALUES[state], host=self.name)
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def allow(self) -> bool:
+        """ True if a call may go through, in half open state only for the probing caller. """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and monotonic() >= self._probe_at:
+                logging.info(f'Circuit {self.name} half open, probing.')
+                self._set_state(HALF_OPEN)
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logging.info(f'Circuit {self.name} closed.')
+            self._set_state(CLOSED)
+            self._failures = 0
+            self._timeout = self.reset_timeout
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN:
+                self._timeout = min(self._timeout * 2, self.max_reset_timeout)
+            elif self._state == OPEN or self._failures < self.failure_threshold:
+                return
+            logging.warning(f'Circuit {self.name} open for {self._timeout:.0f}s after {self._failures} failures.')
+            self._set_state(OPEN)
+            self._probe_at = monotonic() + self._timeout
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+cache.py - Caches for upstream API results
+"""
+
+from typing import Callable, Any, Hashable, Iterable, Tuple
+from collections import OrderedDict
+from threading import Lock, RLock, Event, Thread
+from time import monotonic, time
+from json import dumps, loads
+from os import replace
+from os.path import isfile
+from salsa.metrics import cache_requests
+import atexit
+import logging
+
+
+class TTLValue(object):
+    """
+    Single value cache with TTL, single-flight loading and stale-while-revalidate.
+    Within ttl the cached value is returned. Within ttl + stale_ttl the cached value
+    is returned and one background refresh is started. Otherwise callers block on
+    a single upstream load. Only values accepted by valid are cached, if a load fails
+    the last valid value is returned, its age tells how old it is. If snapshot_file
+    is set, the last valid value is kept there and restored on first use.
+    With a backend the value is shared between processes: a value stored there within
+    ttl is used instead of loading, and only the backend leader loads from upstream.
+    """
+
+    def __init__(self,
+                 loader: Callable[[], Any],
+                 ttl: float,
+                 stale_ttl: float = 0,
+                 valid: Callable[[Any], bool] = lambda v: v is not None,
+                 name: str = 'cache',
+                 snapshot_file: str = None):
+        self._loader = loader
+        self._valid = valid
+        self._name = name
+        self._lock = Lock()
+        self._loading = None
+        self._value = None
+        self._result = None
+        self._loaded_at = None
+        self._invalidated = False
+        self._restored = False
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.snapshot_file = snapshot_file
+        self.backend = None
+
+    @property
+    def age(self) -> float:
+        return None if self._loaded_at is None else monotonic() - self._loaded_at
+
+    def _restore(self):
+        self._restored = True
+        if self.backend is not None:
+            if (entry := self.backend.get(self._name)) is not None and self._valid(entry[0]):
+                self._value = entry[0]
+                self._loaded_at = monotonic() - max(0.0, time() - entry[1])
+        elif self.snapshot_file and isfile(self.snapshot_file):
+            try:
+                with open(self.snapshot_file, 'r') as file:
+                    snapshot = loads(file.read())
+                if self._valid(snapshot['value']):
+                    self._value = snapshot['value']
+                    self._loaded_at = monotonic() - max(0.0, time() - snapshot['time'])
+            except Exception:
+                logging.exception(f'Unable to load {self._name} snapshot {self.snapshot_file}.')
+
+    def _save(self, value: Any):
+        try:
+            with open(f'{self.snapshot_file}.tmp', 'w') as file:
+                file.write(dumps({'value': value, 'time': time()}))
+            replace(f'{self.snapshot_file}.tmp', self.snapshot_file)
+        except OSError:
+            logging.exception(f'Unable to write {self._name} snapshot {self.snapshot_file}.')
+
+    def _fetch(self, force: bool) -> (Any, float, bool):
+        """ (value, time stored, loaded from upstream) """
+        if self.backend is not None and (entry := self.backend.get(self._name)) is not None and \
+                ((not force and time() - entry[1] < self.ttl) or not self.backend.is_leader()):
+            return entry[0], entry[1], False
+        return self._loader(), time(), True
+
+    def _load(self, done: Event, force: bool = False) -> Any:
+        try:
+            result, stored_at, loaded = self._fetch(force)
+        except Exception:
+            logging.exception(f'Loading {self._name} failed.')
+            result, stored_at, loaded = None, time(), True
+        with self._lock:
+            if valid := self._valid(result):
+                self._value = result
+                self._loaded_at = monotonic() - max(0.0, time() - stored_at)
+                self._invalidated = False
+            elif self._loaded_at is not None:
+                logging.warning(f'Loading {self._name} failed, using last valid value from {self.age:.0f}s ago.')
+                result = self._value
+            self._result = result
+            self._loading = None
+        done.set()
+        if valid and loaded:
+            if self.backend is not None:
+                self.backend.put(self._name, result)
+            elif self.snapshot_file:
+                self._save(result)
+        return result
+
+    def _start_load(self) -> (Event, bool):
+        if self._loading is None:
+            self._loading = Event()
+            return self._loading, True
+        return self._loading, False
+
+    def get(self, force_fetch: bool = False) -> Any:
+        with self._lock:
+            if not self._restored:
+                self._restore()
+            age = self.age
+            if not force_fetch and not self._invalidated and age is not None:
+                if age < self.ttl:
+                    cache_requests.inc(cache=self._name, result='hit')
+                    return self._value
+                if age < self.ttl + self.stale_ttl:
+                    cache_requests.inc(cache=self._name, result='stale')
+                    done, leader = self._start_load()
+                    if leader:
+                        Thread(target=self._load, args=(done,), name=f'{self._name} refresh', daemon=True).start()
+                    return self._value
+            cache_requests.inc(cache=self._name, result='miss')
+            done, leader = self._start_load()
+        if leader:
+            return self._load(done, force_fetch)
+        done.wait()
+        return self._result
+
+    def invalidate(self):
+        """ Load on next get, the current value is kept as fallback. """
+        with self._lock:
+            self._invalidated = True
+
+
+class LRUCache(object):
+    """
+    Thread safe LRU cache with TTL and entry count bound. If snapshot_file is set,
+    entries are loaded lazily from it and saved back at most every save_interval
+    seconds and on exit. Keys must be tuples or strings, values are stored with
+    encode/decode so they can be written as JSON. With a backend, entries missing
+    locally are read from it and puts are written through to it instead of the
+    snapshot file, so processes sharing the backend share entries.
+    """
+
+    def __init__(self,
+                 max_entries: int,
+                 ttl: float,
+                 snapshot_file: str = None,
+                 encode: Callable[[Any], Any] = lambda v: v,
+                 decode: Callable[[Any], Any] = lambda v: v,
+                 save_interval: float = 60,
+                 name: str = 'cache'):
+        self._encode = encode
+        self._decode = decode
+        self._name = name
+        self._lock = RLock()
+        self._write_lock = Lock()
+        self._entries = None
+        self._dirty = False
+        self._saved_at = None
+        self._version = 0
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.snapshot_file = snapshot_file
+        self.save_interval = save_interval
+        self.backend = None
+        atexit.register(self.save, force=True)
+
+    def _backend_key(self, key: Hashable) -> str:
+        return f'{self._name}/{dumps(key)}'
+
+    def _shared(self, key: Hashable) -> Tuple[float, Any]:
+        """ Entry of key from the backend if newer than the local one, stored locally, None if there is none. """
+        local = self._entries.get(key)
+        if self.backend is None or (entry := self.backend.get(self._backend_key(key))) is None or \
+                (local is not None and local[0] >= entry[1]):
+            return None
+        entry = self._entries[key] = (entry[1], self._decode(entry[0]))
+        self._entries.move_to_end(key)
+        self._version += 1
+        self._evict()
+        return entry
+
+    def _load(self) -> OrderedDict:
+        if self._entries is None:
+            self._entries = OrderedDict()
+            # With a backend the snapshot file is neither saved nor loaded, entries come from the backend
+            if self.snapshot_file and self.backend is None and isfile(self.snapshot_file):
+                try:
+                    with open(self.snapshot_file, 'r') as file:
+                        for key, loaded_at, value in loads(file.read()):
+                            self._entries[tuple(key) if isinstance(key, list) else key] = \
+                                (loaded_at, self._decode(value))
+                    logging.info(f'Loaded {len(self._entries)} {self._name} entries from {self.snapshot_file}.')
+                except Exception:
+                    logging.exception(f'Unable to load {self._name} snapshot {self.snapshot_file}.')
+                    self._entries = OrderedDict()
+            self._evict()
+        return self._entries
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._dirty = True
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entries = self._load()
+            if (entry := entries.get(key)) is None or time() - entry[0] >= self.ttl:
+                if (shared := self._shared(key)) is not None and time() - shared[0] < self.ttl:
+                    cache_requests.inc(cache=self._name, result='shared')
+                    return shared[1]
+                # Expired entries are kept as fallback for get_stale until replaced or evicted
+                cache_requests.inc(cache=self._name, result='miss' if entry is None and shared is None else 'expired')
+                return None
+            entries.move_to_end(key)
+            cache_requests.inc(cache=self._name, result='hit')
+            return entry[1]
+
+    def get_stale(self, key: Hashable) -> Any:
+        """ Value of key regardless of ttl, e.g. when the upstream is down, the newest one with a backend. """
+        with self._lock:
+            entries = self._load()
+            if (entry := self._shared(key) or entries.get(key)) is None:
+                return None
+            cache_requests.inc(cache=self._name, result='stale')
+            return entry[1]
+
+    def age(self, key: Hashable) -> float:
+        """ Seconds since key was stored, None if not cached. """
+        with self._lock:
+            if (entry := self._load().get(key)) is None and (entry := self._shared(key)) is None:
+                return None
+            return time() - entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        self.put_many([(key, value)])
+
+    def put_many(self, items: Iterable[Tuple[Hashable, Any]]):
+        items = list(items)
+        with self._lock:
+            entries = self._load()
+            now = time()
+            for key, value in items:
+                entries[key] = (now, value)
+                entries.move_to_end(key)
+            self._dirty = True
+            self._version += 1
+            self._evict()
+        if self.backend is not None:
+            self.backend.put_many((self._backend_key(key), self._encode(value)) for key, value in items)
+        else:
+            self.save()
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._dirty = True
+            self._version += 1
+
+    @property
+    def version(self) -> int:
+        """ Counter incremented on every put and clear. """
+        return self._version
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._load())
+
+    def save(self, force: bool = False):
+        """ Write snapshot file if dirty and save_interval has passed since the last write. """
+        with self._write_lock:
+            with self._lock:
+                if not self.snapshot_file or self.backend is not None or not self._dirty or self._entries is None or \
+                        (not force and self._saved_at and monotonic() - self._saved_at < self.save_interval):
+                    return
+                snapshot = dumps([[key, loaded_at, self._encode(value)]
+                                  for key, (loaded_at, value) in self._entries.items()])
+                self._dirty = False
+                self._saved_at = monotonic()
+            try:
+                with open(f'{self.snapshot_file}.tmp', 'w') as file:
+                    file.write(snapshot)
+                replace(f'{self.snapshot_file}.tmp', self.snapshot_file)
+            except OSError:
+                logging.exception(f'Unable to write {self._name} snapshot {self.snapshot_file}.')
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+client.py - Pooled keep-alive HTTP client for upstream APIs
+"""
+
+from typing import Dict, Tuple
+from http.client import HTTPConnection, HTTPSConnection, HTTPException, RemoteDisconnected
+from urllib.parse import urlsplit, urljoin
+from queue import LifoQueue, Empty, Full
+from threading import Lock
+from random import uniform
+from time import sleep
+from salsa.breaker import CircuitBreaker
+import socket
+import ssl
+import logging
+
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+REDIRECT_STATUS = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 3
+# Errors of a pooled connection the server closed while idle
+STALE_ERRORS = (RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class HttpError(Exception):
+    def __init__(self, message: str, status: int = None, reason: str = 'status'):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+class HttpClient(object):
+    """
+    HTTP client keeping a pool of keep-alive connections per host.
+    Failed requests are retried up to retries times with jittered exponential backoff,
+    connection errors, timeouts and 429/5xx responses are retried, other 4xx are not.
+    Each host has a circuit breaker, opened after breaker_threshold failed requests,
+    requests to a host with open circuit fail immediately.
+    """
+
+    def __init__(self,
+                 headers: Dict[str, str] = None,
+                 connect_timeout: float = 4,
+                 read_timeout: float = 8,
+                 retries: int = 2,
+                 backoff: float = 0.5,
+                 pool_size: int = 4,
+                 breaker_threshold: int = 3,
+                 breaker_timeout: float = 15):
+        self._headers = {**(headers or {}), 'Connection': 'keep-alive'}
+        self._lock = Lock()
+        self._pools = {}
+        self._breakers = {}
+        self._ssl_context = ssl.create_default_context()
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+
+    def _pool(self, key: Tuple) -> LifoQueue:
+        with self._lock:
+            if (pool := self._pools.get(key)) is None:
+                pool = self._pools[key] = LifoQueue(maxsize=self.pool_size)
+            return pool
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._lock:
+            if (breaker := self._breakers.get(host)) is None:
+                breaker = self._breakers[host] = CircuitBreaker(host,
+                                                                failure_threshold=self.breaker_threshold,
+                                                                reset_timeout=self.breaker_timeout)
+            return breaker
+
+    def _connect(self, scheme: str, host: str, port: int) -> HTTPConnection:
+        if scheme == 'https':
+            connection = HTTPSConnection(host, port, timeout=self.connect_timeout, context=self._ssl_context)
+        else:
+            connection = HTTPConnection(host, port, timeout=self.connect_timeout)
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection
+
+    def _acquire(self, key: Tuple) -> (HTTPConnection, bool):
+        try:
+            return self._pool(key).get_nowait(), True
+        except Empty:
+            return self._connect(*key), False
+
+    def _release(self, key: Tuple, connection: HTTPConnection):
+        try:
+            self._pool(key).put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def _request(self, url: str) -> (int, str, bytes):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = f'{parts.path or "/"}?{parts.query}' if parts.query else parts.path or '/'
+        connection, reused = self._acquire(key)
+        try:
+            connection.request('GET', path, headers=self._headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (HTTPException, OSError) as e:
+            connection.close()
+            if not reused or not isinstance(e, STALE_ERRORS):
+                raise
+            # Pooled connection was closed by the server, retry once on a fresh one.
+            # Timeouts and other errors are counted retries in _get.
+            connection = self._connect(*key)
+            try:
+                connection.request('GET', path, headers=self._headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (HTTPException, OSError):
+                connection.close()
+                raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(key, connection)
+        return response.status, response.getheader('Location'), body
+
+    def get(self, url: str) -> bytes:
+        """ GET url and return response body, raises HttpError after all retries failed or if the circuit is open. """
+        host = urlsplit(url).hostname
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            raise HttpError(f'Circuit for {host} is open, skipping request to {url}', reason='circuit_open')
+        failed = True
+        try:
+            body = self._get(url)
+            failed = False
+            return body
+        except HttpError as e:
+            # Client errors show the host is up
+            failed = e.status is None or e.status in RETRY_STATUS
+            raise
+        finally:
+            if failed:
+                breaker.failure()
+            else:
+                breaker.success()
+
+    def _get(self, url: str) -> bytes:
+        attempt = 0
+        redirects = 0
+        while True:
+            try:
+                status, location, body = self._request(url)
+            except (HTTPException, OSError) as e:
+                error = HttpError(f'Request to {url} failed: {e!r}',
+                                  reason='timeout' if isinstance(e, socket.timeout) else 'connection')
+            else:
+                if status in REDIRECT_STATUS and location and redirects < MAX_REDIRECTS:
+                    url = urljoin(url, location)
+                    redirects += 1
+                    continue
+                if 200 <= status < 300:
+                    return body
+                error = HttpError(f'Request to {url} returned status {status}', status)
+                if status not in RETRY_STATUS:
+                    raise error
+            if attempt >= self.retries:
+                raise error
+            delay = uniform(0, self.backoff * 2 ** attempt)
+            logging.warning(f'{error} Retrying in {delay:.2f}s.')
+            sleep(delay)
+            attempt += 1
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except Empty:
+                    break
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+intervals.py - Interval index over the outage schedules of all blocks of a stage
+"""
+
+from typing import Dict, Iterable, List, Tuple
+from array import array
+from bisect import bisect_right
+from salsa.schedule import Schedule
+
+
+class OutageIndex(object):
+    """
+    All slots of a stage sorted by start. Slots overlapping a window [from, to] start in
+    (from - max_duration, to], so window and point queries are a binary search plus
+    a scan over candidates only.
+    """
+
+    def __init__(self, schedules: Dict[str, Schedule]):
+        slots = sorted((start, end, block)
+                       for block, schedule in schedules.items()
+                       for start, end in zip(schedule.starts, schedule.ends))
+        self._schedules = schedules
+        self._starts = array('q', (s[0] for s in slots))
+        self._ends = array('q', (s[1] for s in slots))
+        self._blocks = [s[2] for s in slots]
+        self._max_duration = max((end - start for start, end, _ in slots), default=0)
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def between(self, from_timestamp: int, to_timestamp: int) -> List[Tuple[str, int, int]]:
+        """ (block, start, end) of slots with start <= to_timestamp and end > from_timestamp. """
+        i = bisect_right(self._starts, from_timestamp - self._max_duration)
+        j = bisect_right(self._starts, to_timestamp, lo=i)
+        return [(self._blocks[k], self._starts[k], self._ends[k])
+                for k in range(i, j) if self._ends[k] > from_timestamp]
+
+    def at(self, timestamp: int) -> List[Tuple[str, int, int]]:
+        """ (block, start, end) of slots ongoing at timestamp. """
+        return self.between(timestamp, timestamp)
+
+    def next(self, timestamp: int, blocks: Iterable[str]) -> Dict[str, Tuple[int, int]]:
+        """ Ongoing or next (start, end) slot per block, None for blocks without one. """
+        result = {}
+        for block in blocks:
+            schedule = self._schedules.get(block)
+            slot = schedule.next(timestamp) if schedule is not None else None
+            result[block] = slot[:2] if slot else None
+        return result
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+metrics.py - Counters, gauges and histograms rendered in Prometheus text format
+"""
+
+from typing import Callable, Dict, Iterable, List, Tuple
+from threading import Lock
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(labels: Dict[str, str]) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: Tuple, extra: Tuple = ()) -> str:
+    if not labels and not extra:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels + extra) + '}'
+
+
+def _format_value(value: float) -> str:
+    return 'NaN' if value != value else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._lock = Lock()
+        self._values = {}
+
+    def samples(self) -> Iterable[Tuple[str, Tuple, float]]:
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{_format_labels(labels)} {_format_value(value)}' for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels(labels), 0)
+
+
+class Gauge(Metric):
+    """ Gauge with set values or a function called on collection. """
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, function: Callable[[], float] = None):
+        super().__init__(name, description)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+    def samples(self) -> Iterable[Tuple[str, Tuple, float]]:
+        if self.function is not None:
+            try:
+                return [(self.name, (), self.function())]
+            except Exception:
+                return []
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float] = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            if (entry := self._values.get(key)) is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self) -> Iterable[Tuple[str, Tuple, float]]:
+        samples = []
+        with self._lock:
+            for labels, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else _format_value(float(bound))
+                    samples.append((f'{self.name}_bucket', labels + (('le', le),), cumulative))
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, count))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}
+
+    def _register(self, name: str, factory: Callable[[], Metric]) -> Metric:
+        with self._lock:
+            if (metric := self._metrics.get(name)) is None:
+                metric = self._metrics[name] = factory()
+            return metric
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._register(name, lambda: Counter(name, description))
+
+    def gauge(self, name: str, description: str, function: Callable[[], float] = None) -> Gauge:
+        gauge = self._register(name, lambda: Gauge(name, description))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, description: str, buckets: Tuple[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(name, lambda: Histogram(name, description, buckets))
+
+    def render(self) -> str:
+        """ All metrics in Prometheus text exposition format. """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+    def snapshot(self) -> Dict[str, float]:
+        """ Flat sample name to value dict, histogram buckets excluded. """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {f'{name}{_format_labels(labels)}': value
+                for metric in metrics
+                for name, labels, value in metric.samples()
+                if not name.endswith('_bucket')}
+
+
+registry = Registry()
+
+upstream_latency = registry.histogram('salsa_upstream_request_seconds', 'Upstream request latency by endpoint.')
+upstream_errors = registry.counter('salsa_upstream_errors_total', 'Failed upstream requests by endpoint and reason.')
+cache_requests = registry.counter('salsa_cache_requests_total', 'Cache lookups by cache and result.')
+upstream_circuit = registry.gauge('salsa_upstream_circuit_state',
+                                  'Upstream circuit breaker state by host, 0 closed, 1 half open, 2 open.')
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+profiling.py - Opt-in profiling of slow calls
+
+Functions decorated with profiled are profiled while the profiler is enabled, calls
+taking threshold seconds or longer are kept as records. Disabled, the decorator costs
+one attribute check per call. Modes:
+  cprofile - deterministic cProfile stats, dumped as pstats files
+  sample   - call stacks sampled every interval seconds, dumped in the collapsed
+             stack format of flamegraph.pl and speedscope
+Only the outermost profiled call of a thread is recorded, nested profiled calls are
+part of its profile.
+"""
+
+from typing import Any, Callable, Dict, Iterable, List
+from collections import Counter, deque
+from functools import wraps
+from threading import Lock, Thread, Event, local, current_thread
+from time import monotonic, time
+from os import makedirs
+from os.path import basename, join
+from io import StringIO
+import cProfile
+import marshal
+import pstats
+import sys
+import logging
+
+
+CPROFILE = 'cprofile'
+SAMPLE = 'sample'
+MODES = (CPROFILE, SAMPLE)
+THRESHOLD = 0.5        # in seconds
+SAMPLE_INTERVAL = 0.005  # in seconds
+MAX_RECORDS = 50
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class Record(object):
+    """ Profile of one slow call, stats in cprofile mode, stacks in sample mode. """
+
+    def __init__(self, id: int, name: str, started: float, duration: float, thread: str,
+                 stats: pstats.Stats = None, stacks: Counter = None):
+        self.id = id
+        self.name = name
+        self.started = started
+        self.duration = duration
+        self.thread = thread
+        self.stats = stats
+        self.stacks = stacks
+
+    def to_json(self) -> Dict:
+        return {'id': self.id,
+                'name': self.name,
+                'started': self.started,
+                'duration': round(self.duration, 6),
+                'thread': self.thread,
+                'mode': CPROFILE if self.stats is not None else SAMPLE}
+
+
+class _Call(object):
+    __slots__ = ('frame', 'stacks')
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.stacks = Counter()
+
+
+class Profiler(object):
+    """ Records the last max_records calls of profiled functions that took threshold seconds or longer. """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._local = local()
+        self._records = deque()
+        self._ids = 0
+        self._calls = {}
+        self._sampler = None
+        self._stopper = Event()
+        self.enabled = False
+        self.mode = CPROFILE
+        self.threshold = THRESHOLD
+        self.interval = SAMPLE_INTERVAL
+        self.max_records = MAX_RECORDS
+        self.directory = None
+
+    def enable(self,
+               mode: str = CPROFILE,
+               threshold: float = THRESHOLD,
+               interval: float = SAMPLE_INTERVAL,
+               max_records: int = MAX_RECORDS,
+               directory: str = None):
+        """ Start profiling, if directory is set every record is also dumped there. """
+        if mode not in MODES:
+            raise ValueError(f'Unknown profiling mode {mode}, use one of {", ".join(MODES)}.')
+        self.disable()
+        self.mode, self.threshold, self.interval, self.max_records, self.directory = \
+            mode, threshold, interval, max_records, directory
+        if directory:
+            makedirs(directory, exist_ok=True)
+        if mode == SAMPLE:
+            self._stopper.clear()
+            self._sampler = Thread(target=self._sample, name='Profile sampler', daemon=True)
+            self._sampler.start()
+        self.enabled = True
+        logging.info(f'Profiling calls over {threshold}s in {mode} mode.')
+
+    def disable(self):
+        self.enabled = False
+        if self._sampler is not None:
+            self._stopper.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def _sample(self):
+        while not self._stopper.wait(self.interval):
+            with self._lock:
+                calls = list(self._calls.items())
+            if not calls:
+                continue
+            frames = sys._current_frames()
+            for ident, call in calls:
+                stack = []
+                frame = frames.get(ident)
+                while frame is not None and frame is not call.frame:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                if frame is not None:
+                    call.stacks[';'.join(reversed(stack))] += 1
+
+    def call(self, name: str, function: Callable, *args, **kwargs) -> Any:
+        """ Call function, profiled unless a profiled call of this thread is already running. """
+        if getattr(self._local, 'active', False):
+            return function(*args, **kwargs)
+        self._local.active = True
+        profile, call = None, None
+        if self.mode == CPROFILE:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Since Python 3.12 one cProfile can be active at a time across threads
+                profile = None
+        else:
+            call = _Call(sys._getframe())
+            with self._lock:
+                self._calls[current_thread().ident] = call
+        started, start = time(), monotonic()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if profile is not None:
+                profile.disable()
+            duration = monotonic() - start
+            self._local.active = False
+            if call is not None:
+                with self._lock:
+                    self._calls.pop(current_thread().ident, None)
+            if duration >= self.threshold and (profile is not None or call is not None):
+                self._record(name, started, duration, profile, call)
+
+    def _record(self, name: str, started: float, duration: float, profile: cProfile.Profile, call: _Call):
+        stats = pstats.Stats(profile) if profile is not None else None
+        stacks = Counter({f'{name};{stack}' if stack else name: count for stack, count in call.stacks.items()}) \
+            if call is not None else None
+        with self._lock:
+            self._ids += 1
+            record = Record(self._ids, name, started, duration, current_thread().name, stats, stacks)
+            self._records.append(record)
+            while len(self._records) > self.max_records:
+                self._records.popleft()
+        logging.debug(f'Profiled {name} taking {duration:.3f}s as record {record.id}.')
+        if self.directory:
+            try:
+                self.dump(join(self.directory, f'{name.strip("/").replace("/", "_").replace(" ", "_")}-'
+                                               f'{record.id}.{"prof" if stats is not None else "collapsed"}'),
+                          [record])
+            except OSError:
+                logging.exception(f'Unable to dump profile record {record.id}.')
+
+    def records(self, name: str = None, ids: Iterable[int] = None) -> List[Record]:
+        """ Records, oldest first, of name and ids if given. """
+        ids = None if ids is None else set(ids)
+        with self._lock:
+            return [r for r in self._records if (name is None or r.name == name) and (ids is None or r.id in ids)]
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    @staticmethod
+    def stats(records: Iterable[Record]) -> pstats.Stats:
+        """ Combined cProfile stats of records, None if there are none. """
+        if not (profiles := [record.stats for record in records if record.stats is not None]):
+            return None
+        return pstats.Stats().add(*profiles)
+
+    @staticmethod
+    def pstats_data(records: Iterable[Record]) -> bytes:
+        """ Combined cProfile stats of records in pstats file format, None if there are none. """
+        return None if (stats := Profiler.stats(records)) is None else marshal.dumps(stats.stats)
+
+    @staticmethod
+    def collapsed(records: Iterable[Record]) -> str:
+        """ Combined sampled stacks of records in collapsed stack format. """
+        stacks = Counter()
+        for record in records:
+            if record.stacks is not None:
+                stacks.update(record.stacks)
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
+
+    @staticmethod
+    def text(records: Iterable[Record], sort: str = 'cumulative', limit: int = 40) -> str:
+        """ Combined cProfile stats of records as text, top limit functions by sort. """
+        if (stats := Profiler.stats(records)) is None:
+            return ''
+        output = StringIO()
+        stats.stream = output
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    @staticmethod
+    def dump(path: str, records: Iterable[Record]):
+        """ Write records as pstats file if path ends with .prof, in collapsed stack format otherwise. """
+        if path.endswith('.prof'):
+            if (data := Profiler.pstats_data(records)) is not None:
+                with open(path, 'wb') as file:
+                    file.write(data)
+        else:
+            with open(path, 'w') as file:
+                file.write(Profiler.collapsed(records))
+
+
+profiler = Profiler()
+
+
+def profiled(name: str) -> Callable:
+    """ Decorator profiling calls of the function as name while the profiler is enabled. """
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            return profiler.call(name, function, *args, **kwargs)
+        return wrapper
+    return decorator
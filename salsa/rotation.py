@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+rotation.py - Schedule projection from the repeating load shedding rotation
+
+The timetable of a (stage, block) repeats after a fixed period. The period and the slots
+of one period are learned from a fetched schedule, then slots are computed locally for
+any date range without upstream requests.
+"""
+
+from typing import Dict, Iterable, Tuple
+from array import array
+from bisect import bisect_left, bisect_right
+from json import dumps, loads
+from os import replace
+from time import time
+from salsa.schedule import Schedule
+
+
+ROTATION_VERSION = 1
+MIN_SLOTS = 4  # slots a schedule needs before a period is learned from it
+
+
+class Rotation(object):
+    """ Slots of one period as offsets from epoch, repeated every period seconds. """
+
+    __slots__ = ('epoch', 'period', 'offsets', 'durations', 'ids')
+
+    def __init__(self, epoch: int, period: int, offsets: Iterable[int], durations: Iterable[int], ids: Iterable[int]):
+        self.epoch = epoch
+        self.period = period
+        self.offsets = array('q', offsets)
+        self.durations = array('q', durations)
+        self.ids = array('q', ids)
+
+    @staticmethod
+    def learn(schedule: Schedule) -> 'Rotation':
+        """
+        Shortest period the schedule repeats with, None if it does not repeat.
+        A period is accepted if every slot followed by a full period of data recurs one
+        period later, every slot after the first period occurred one period earlier,
+        and at least two full periods are checked this way, so two slots alone never
+        make a rotation.
+        """
+        starts, ends, ids = schedule.starts, schedule.ends, schedule.ids
+        if len(starts) < MIN_SLOTS:
+            return None
+        slots = dict(zip(starts, ends))
+        first, last = starts[0], starts[-1]
+        for period in sorted({start - first for start in starts[1:]}):
+            table = bisect_left(starts, first + period)
+            checked = bisect_right(starts, last - period)
+            if checked >= 2 * table and \
+                    all(slots.get(starts[i] + period) == ends[i] + period for i in range(checked)) and \
+                    all(slots.get(starts[i] - period) == ends[i] - period for i in range(table, len(starts))):
+                return Rotation(first, period,
+                                (start - first for start in starts[:table]),
+                                (end - start for start, end in zip(starts[:table], ends[:table])),
+                                ids[:table])
+        return None
+
+    def project(self, from_timestamp: int, to_timestamp: int) -> Schedule:
+        """ Slots with from_timestamp <= start <= to_timestamp. """
+        first = (from_timestamp - self.epoch) // self.period
+        last = (to_timestamp - self.epoch) // self.period
+        bases = range(self.epoch + first * self.period, self.epoch + (last + 1) * self.period, self.period)
+        starts = array('q', (base + offset for base in bases for offset in self.offsets))
+        i = bisect_left(starts, from_timestamp)
+        j = bisect_right(starts, to_timestamp, lo=i)
+        repeats = len(bases)
+        return Schedule.from_arrays(starts[i:j],
+                                    array('q', (start + duration for start, duration
+                                                in zip(starts[i:j], (self.durations * repeats)[i:j]))),
+                                    (self.ids * repeats)[i:j])
+
+    def to_json(self) -> list:
+        return [self.epoch, self.period, self.offsets.tolist(), self.durations.tolist(), self.ids.tolist()]
+
+    @staticmethod
+    def from_json(data: list) -> 'Rotation':
+        return Rotation(*data)
+
+
+class RotationTable(object):
+    """ Rotations of all learned (stage, block) pairs, saved to and loaded from a JSON file. """
+
+    def __init__(self, rotations: Dict[Tuple[int, str], Rotation], created: float = None):
+        self.rotations = rotations
+        self.created = time() if created is None else created
+
+    @staticmethod
+    def learn(schedules: Iterable[Tuple[int, str, Schedule]]) -> 'RotationTable':
+        return RotationTable({(stage, block): rotation
+                              for stage, block, schedule in schedules
+                              if (rotation := Rotation.learn(schedule)) is not None})
+
+    def __len__(self) -> int:
+        return len(self.rotations)
+
+    def get(self, stage: int, block: str) -> Rotation:
+        return self.rotations.get((stage, block))
+
+    def project(self, stage: int, block: str, from_timestamp: int, to_timestamp: int) -> Schedule:
+        """ Projected schedule of stage and block, None if its rotation is unknown. """
+        rotation = self.rotations.get((stage, block))
+        return None if rotation is None else rotation.project(from_timestamp, to_timestamp)
+
+    def project_all(self,
+                    from_timestamp: int,
+                    to_timestamp: int,
+                    stages: Iterable[int] = None,
+                    blocks: Iterable[str] = None) -> Dict[Tuple[int, str], Schedule]:
+        """ Projected schedules of all, or the given, stages and blocks. """
+        stages = None if stages is None else set(stages)
+        blocks = None if blocks is None else set(blocks)
+        return {(stage, block): rotation.project(from_timestamp, to_timestamp)
+                for (stage, block), rotation in self.rotations.items()
+                if (stages is None or stage in stages) and (blocks is None or block in blocks)}
+
+    def save(self, path: str):
+        with open(f'{path}.tmp', 'w') as file:
+            file.write(dumps({'version': ROTATION_VERSION,
+                              'created': self.created,
+                              'rotations': [[stage, block, *rotation.to_json()]
+                                            for (stage, block), rotation in self.rotations.items()]}))
+        replace(f'{path}.tmp', path)
+
+    @staticmethod
+    def load(path: str) -> 'RotationTable':
+        with open(path, 'r') as file:
+            data = loads(file.read())
+        if data.get('version') != ROTATION_VERSION:
+            raise ValueError(f'Rotation file {path} has unsupported version {data.get("version")}')
+        return RotationTable({(r[0], r[1]): Rotation.from_json(r[2:]) for r in data['rotations']}, data['created'])
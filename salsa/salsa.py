@@ -3,12 +3,26 @@
 salsa.py - Load shedding API for CityPower customers
 """
 
-from typing import Callable, Any, Dict
-from urllib.request import Request, urlopen
+from typing import Callable, Any, Dict, Iterable, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, RLock
+from time import monotonic, time
 from json import dumps, loads
 from os.path import isfile
+from math import ceil, floor
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
-import sys
+from salsa.cache import TTLValue, LRUCache
+from salsa.client import HttpClient, HttpError
+from salsa.schedule import Schedule, to_datetime
+from salsa.intervals import OutageIndex
+from salsa.snapshot import Snapshot, write_snapshot
+from salsa.search import SearchIndex, DEFAULT_LIMIT
+from salsa.rotation import RotationTable
+from salsa.profiling import profiled
+from salsa import metrics
+import logging
+import re
 
 
 HEADERS = {'Accept': 'application/json;odata=verbose'}
@@ -17,97 +31,547 @@ API_GET_SUBURBS = "https://www.citypower.co.za/_api/web/lists/getByTitle('LoadSh
                   "$select=*,SubBlock/Title&$expand=SubBlock&$top=2000"
 API_GET_SCHEDULE = "https://www.citypower.co.za/_api/web/lists/getByTitle('Loadshedding')/items?"\
                    "$select=*&$filter=Title%20eq%20'Stage{stage}'%20and%20substringof('{block}',SubBlock)&$top=2000"
+API_GET_STAGE_SCHEDULE = "https://www.citypower.co.za/_api/web/lists/getByTitle('Loadshedding')/items?"\
+                         "$select=*&$filter=Title%20eq%20'Stage{stage}'&$top=2000"
+
+HTTP_CONNECT_TIMEOUT = 4  # in seconds
+HTTP_READ_TIMEOUT = 8     # in seconds
+HTTP_RETRIES = 2
+BREAKER_THRESHOLD = 3     # failed requests
+BREAKER_TIMEOUT = 15      # in seconds
 
 SUBURBS_CACHE_FILE = 'suburbs.json'
+STAGE_CACHE_TTL = 60         # in seconds
+STAGE_CACHE_STALE_TTL = 240  # in seconds
+STAGE_CACHE_FILE = 'stage.json'
+PREFETCH_STAGES = range(1, 9)
+SCHEDULE_CACHE_FILE = 'schedules.json'
+SCHEDULE_CACHE_TTL = 12 * 60 * 60  # in seconds
+SCHEDULE_CACHE_SIZE = 4096         # (stage, block) entries
+SCHEDULE_WORKERS = 8               # concurrent schedule loads of get_schedules
+SNAPSHOT_FILE = 'salsa.db'
+ROTATION_FILE = 'rotation.json'
+ROTATION_DAYS = 31  # full schedules projected from the rotation cover yesterday to ROTATION_DAYS ahead
 
 
 def time_in_millis(time: datetime) -> int:
     return int(round(time.timestamp() * 1000))
 
 
-def http_get(url: str, parser: Callable = lambda x: x, error: Any = None) -> Any:
-    request = Request(url, headers=HEADERS)
+http_client = HttpClient(HEADERS,
+                         connect_timeout=HTTP_CONNECT_TIMEOUT,
+                         read_timeout=HTTP_READ_TIMEOUT,
+                         retries=HTTP_RETRIES,
+                         breaker_threshold=BREAKER_THRESHOLD,
+                         breaker_timeout=BREAKER_TIMEOUT)
+
+
+@profiled('http_get')
+def http_get(url: str, parser: Callable = lambda x: x, error: Any = None, endpoint: str = 'other') -> Any:
+    start = monotonic()
     try:
-        response = urlopen(request, timeout=4)
-    except:
-        print('Server error.')
-        print(f'> {sys.exc_info()}')
+        result = loads(http_client.get(url))
+    except HttpError as e:
+        if e.reason == 'circuit_open':
+            logging.debug(str(e))
+        else:
+            logging.error(f'Server error. {e}')
+        metrics.upstream_errors.inc(endpoint=endpoint, reason=e.reason)
+        return error
+    except ValueError as e:
+        logging.error(f'Invalid response from {url}. {e}')
+        metrics.upstream_errors.inc(endpoint=endpoint, reason='invalid')
         return error
     else:
-        result = loads(response.read())
         return parser(result)
+    finally:
+        metrics.upstream_latency.observe(monotonic() - start, endpoint=endpoint)
 
 
-def load_suburbs() -> [str]:
-    with open(SUBURBS_CACHE_FILE, 'r') as file:
+def http_get_paged(url: str, parser: Callable = lambda x: x, error: Any = None, endpoint: str = 'other') -> Any:
+    """ Fetch all result pages of an OData query, following __next links. """
+    results = []
+    while url:
+        if (page := http_get(url, endpoint=endpoint)) is None:
+            return error
+        results.extend(page['d']['results'])
+        url = page['d'].get('__next')
+    return parser(results)
+
+
+def load_suburbs(cache_file: str = SUBURBS_CACHE_FILE) -> [Dict]:
+    with open(cache_file, 'r') as file:
         return loads(file.read())
 
 
-def get_suburbs(force_fetch: bool = False) -> [str]:
-    subs = load_suburbs() if isfile(SUBURBS_CACHE_FILE) and not force_fetch else \
-        http_get(API_GET_SUBURBS, lambda res: [{'title': r['Title'],
-                                                'id': r['ID'],
-                                                'block': r['SubBlock']['Title']}
-                                               for r in res['d']['results']],
-                 {'d': {'results': []}})
-    with open(SUBURBS_CACHE_FILE, 'w') as file:
-        file.write(dumps(subs))
-    return subs;
+def fetch_suburbs() -> [Dict]:
+    return http_get(API_GET_SUBURBS, lambda res: [{'title': r['Title'],
+                                                   'id': r['ID'],
+                                                   'block': r['SubBlock']['Title']}
+                                                  for r in res['d']['results']],
+                    [], endpoint='suburbs')
+
+
+class SuburbIndex(object):
+    """
+    Process wide suburb index, loaded once and shared between threads.
+    Readers work on an immutable snapshot, reload and refresh swap it under a lock.
+    With a backend, suburbs are kept there instead of the cache file and only the
+    backend leader fetches them from upstream.
+    """
+
+    def __init__(self, cache_file: str = SUBURBS_CACHE_FILE):
+        self._cache_file = cache_file
+        self._lock = RLock()
+        self._snapshot = None
+        self.backend = None
+
+    @staticmethod
+    def _build(suburbs: [Dict]) -> Tuple:
+        by_title = sorted(suburbs, key=lambda s: s['title'])
+        by_block = {}
+        for suburb in by_title:
+            by_block.setdefault(suburb['block'], []).append(suburb)
+        return suburbs, by_block, [(s['title'].lower(), s) for s in by_title], SearchIndex(suburbs)
+
+    def _get(self) -> Tuple:
+        if (snapshot := self._snapshot) is None:
+            with self._lock:
+                if (snapshot := self._snapshot) is None:
+                    snapshot = self.reload()
+        return snapshot
+
+    def _shared(self) -> [Dict]:
+        return None if self.backend is None or (entry := self.backend.get('suburbs')) is None else entry[0]
+
+    def reload(self) -> Tuple:
+        """ Reload suburbs from backend or cache file, fetch from upstream if there are none. """
+        with self._lock:
+            if suburbs := self._shared():
+                self._snapshot = self._build(suburbs)
+            elif self.backend is not None or not isfile(self._cache_file):
+                return self.refresh()
+            else:
+                self._snapshot = self._build(load_suburbs(self._cache_file))
+            return self._snapshot
+
+    def refresh(self) -> Tuple:
+        """ Fetch suburbs from upstream and rewrite cache file. Keeps current index on error. """
+        with self._lock:
+            if self.backend is not None and not self.backend.is_leader() and (suburbs := self._shared()):
+                self._snapshot = self._build(suburbs)
+            elif suburbs := fetch_suburbs():
+                if self.backend is not None:
+                    self.backend.put('suburbs', suburbs)
+                else:
+                    with open(self._cache_file, 'w') as file:
+                        file.write(dumps(suburbs))
+                self._snapshot = self._build(suburbs)
+            elif self._snapshot is None:
+                self._snapshot = self._build([])
+            return self._snapshot
+
+    @property
+    def suburbs(self) -> [Dict]:
+        return self._get()[0]
+
+    @property
+    def blocks(self) -> [str]:
+        return list(self._get()[1].keys())
+
+    def has_block(self, block: str) -> bool:
+        return block in self._get()[1]
+
+    def by_block(self, block: str) -> [Dict]:
+        return list(self._get()[1].get(block, []))
+
+    def by_name(self, name: str) -> [Dict]:
+        name_str = name.lower()
+        return [s for title, s in self._get()[2] if name_str in title]
+
+    @property
+    def search(self) -> SearchIndex:
+        return self._get()[3]
+
+
+suburb_index = SuburbIndex()
+offline_snapshot = None
+
+
+def use_snapshot(path: str = SNAPSHOT_FILE):
+    """ Answer all queries from a compiled snapshot file, without upstream requests. """
+    global suburb_index, offline_snapshot
+    offline_snapshot = suburb_index = Snapshot(path)
+
+
+def get_suburbs(force_fetch: bool = False) -> [Dict]:
+    if force_fetch:
+        suburb_index.refresh()
+    return suburb_index.suburbs
+
+
+def reload_suburbs(force_fetch: bool = False) -> [Dict]:
+    suburb_index.refresh() if force_fetch else suburb_index.reload()
+    return suburb_index.suburbs
 
 
 def get_block(name: str = None, block: str = None) -> str:
     if block:
         ublock = block.upper()
-        for suburb in get_suburbs():
-            if suburb['block'] == ublock:
-                return ublock
+        if suburb_index.has_block(ublock):
+            return ublock
         raise ValueError(f'Block {ublock} does not exist')
     elif name:
         suburbs = find_suburb(name)
-        if len(suburbs) == 1:
+        if len({s['block'] for s in suburbs}) == 1:
             return suburbs[0]['block']
-        raise ValueError(f'Suburb \'{name}\' does not exist' if len(suburbs) == 0 else
-                         f'Found {len(suburbs)} suburbs \'{name}\', find block id and us it for schedule query.')
+        if len(exact := [s for s in suburbs if s['title'].lower() == name.lower()]) == 1:
+            return exact[0]['block']
+        if len(suburbs) == 0:
+            suggestions = suggest_suburbs(name, limit=3)
+            raise ValueError(f'Suburb \'{name}\' does not exist' +
+                             (f', did you mean {", ".join(s["title"] for s in suggestions)}?' if suggestions else ''))
+        raise ValueError(f'Found {len(suburbs)} suburbs \'{name}\', find block id and us it for schedule query.')
     else:
         raise ValueError(f'No name nor block provided.')
 
 
 def find_suburb(name: str = None, block: str = None) -> [Dict]:
-    subs = get_suburbs()
     if block:
-        ublock = block.upper()
-        return sorted([s for s in subs if s['block'] == ublock], key=lambda s: s['title'])
+        return suburb_index.by_block(block.upper())
     elif name:
-        name_str = name.lower()
-        return sorted([s for s in subs if name_str in s['title'].lower()], key=lambda s: s['title'])
+        return suburb_index.by_name(name)
     else:
         raise ValueError("Provide name or block id")
 
 
-def get_stage() -> int:
-    return http_get(API_GET_STATUS.format(timestamp=str(time_in_millis(datetime.now()))), error=-4) - 1
+def suggest_suburbs(query: str, limit: int = DEFAULT_LIMIT) -> [Dict]:
+    """ Ranked fuzzy matches of query in suburb titles, with score. """
+    return suburb_index.search.suggest(query, limit)
+
+
+def fetch_stage() -> int:
+    return http_get(API_GET_STATUS.format(timestamp=str(time_in_millis(datetime.now()))),
+                    error=-4, endpoint='stage') - 1
+
+
+stage_cache = TTLValue(fetch_stage,
+                       ttl=STAGE_CACHE_TTL,
+                       stale_ttl=STAGE_CACHE_STALE_TTL,
+                       valid=lambda s: s is not None and s >= 0,
+                       name='stage',
+                       snapshot_file=STAGE_CACHE_FILE)
+
+
+def get_stage(force_fetch: bool = False) -> int:
+    """ Current stage, the last known stage if the upstream is down, see get_stage_age. """
+    if offline_snapshot is not None:
+        return offline_snapshot.stage
+    return stage_cache.get(force_fetch)
+
+
+def get_stage_age() -> float:
+    """ Seconds since the stage returned by get_stage was fetched, None if unknown. """
+    if offline_snapshot is not None:
+        return time() - offline_snapshot.created
+    return stage_cache.age
+
+
+def parse_blocks(sub_block: str) -> [str]:
+    return [b for b in re.split(r'[,;/\s]+', (sub_block or '').upper()) if b]
+
+
+def fetch_schedule(stage: int, block: str) -> Schedule:
+    # substringof also matches blocks containing block, e.g. 11A and 21A for 1A
+    return http_get(API_GET_SCHEDULE.format(block=block, stage=stage),
+                    lambda res: Schedule.from_records([r for r in res['d']['results']
+                                                       if block in parse_blocks(r.get('SubBlock'))]),
+                    endpoint='schedule')
+
+
+def fetch_stage_schedules(stage: int) -> Dict[str, Schedule]:
+    """ Fetch full schedule table for stage in one paged query and split it into per block schedules. """
+    results = http_get_paged(API_GET_STAGE_SCHEDULE.format(stage=stage), error=None, endpoint='stage_schedule')
+    if results is None:
+        return {}
+    records = {}
+    for record in results:
+        for block in parse_blocks(record.get('SubBlock')):
+            records.setdefault(block, []).append(record)
+    return {block: Schedule.from_records(r) for block, r in records.items()}
+
+
+schedule_cache = LRUCache(max_entries=SCHEDULE_CACHE_SIZE,
+                          ttl=SCHEDULE_CACHE_TTL,
+                          snapshot_file=SCHEDULE_CACHE_FILE,
+                          encode=Schedule.to_json,
+                          decode=Schedule.from_json,
+                          name='schedule')
+
+
+cache_backend = None
+
+
+def use_backend(backend):
+    """ Share stage, suburbs and schedules with other processes through backend, see salsa.backend. """
+    global cache_backend
+    cache_backend = stage_cache.backend = schedule_cache.backend = suburb_index.backend = backend
+
+
+def is_leader() -> bool:
+    """ True if this process polls the upstream, always without a shared backend. """
+    return cache_backend is None or cache_backend.is_leader()
+
+
+def prefetch(stages: [int] = PREFETCH_STAGES) -> Dict[int, int]:
+    """ Warm schedule cache for all blocks of stages. Returns number of blocks fetched per stage. """
+    counts = {}
+    for stage in stages:
+        if schedules := fetch_stage_schedules(stage):
+            schedule_cache.put_many(((stage, block), schedules.get(block, Schedule()))
+                                    for block in set(suburb_index.blocks) | schedules.keys())
+        counts[stage] = len(schedules)
+    schedule_cache.save(force=True)
+    return counts
+
+
+rotation_table = None
+
+
+def learn_rotation(path: str = ROTATION_FILE, stages: [int] = PREFETCH_STAGES) -> RotationTable:
+    """ Learn the rotation of all blocks and stages from their schedules and save it to path, unless none is learned. """
+    blocks = suburb_index.blocks
+    schedules = []
+    for stage in stages:
+        _warm_cache(stage, blocks)
+        schedules.extend((stage, block, _fetched_schedule(stage, block)) for block in blocks)
+    table = RotationTable.learn(schedules)
+    if not table:
+        # Nothing to learn from schedules of failed fetches, keep any saved table
+        logging.warning(f'No rotation learned of {len(schedules)} stage blocks, not saving {path}.')
+        return table
+    table.save(path)
+    logging.info(f'Learned rotation of {len(table)} of {len(schedules)} stage blocks.')
+    return table
+
+
+def use_rotation(path: str = ROTATION_FILE):
+    """
+    Project schedules locally from the rotation table in path, learned again if path does not exist,
+    the table is empty or older than the rotation window.
+    """
+    global rotation_table
+    table = RotationTable.load(path) if isfile(path) else None
+    if table is None or not table or time() - table.created > ROTATION_DAYS * 24 * 3600:
+        learned = learn_rotation(path)
+        table = learned if learned or table is None else table
+    rotation_table = table
+
+
+def _rotation_window() -> Tuple[int, int]:
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return int((today - timedelta(days=1)).timestamp()), int((today + timedelta(days=ROTATION_DAYS)).timestamp())
+
+
+def _projected(stage: int, block: str, from_timestamp: int, to_timestamp: int) -> Schedule:
+    if rotation_table is None:
+        return None
+    return rotation_table.project(stage, block, from_timestamp, to_timestamp)
+
+
+def warm_schedules(stage: int, blocks: [str]) -> int:
+    """ Load schedules of blocks missing in cache, with one bulk stage query if more than one is missing. """
+    if rotation_table is not None and all(rotation_table.get(stage, block) for block in blocks):
+        return 0
+    return _warm_cache(stage, blocks)
+
+
+def _warm_cache(stage: int, blocks: [str]) -> int:
+    if offline_snapshot is not None:
+        return 0
+    missing = [block for block in blocks if _cached_schedule(stage, block) is None]
+    if len(missing) > 1:
+        prefetch([stage])
+    return len(missing)
+
+
+@lru_cache(maxsize=SCHEDULE_CACHE_SIZE)
+def _projected_window(table: RotationTable, stage: int, block: str, window: Tuple[int, int]) -> Schedule:
+    return table.project(stage, block, *window)
+
+
+def get_full_schedule(stage: int, block: str) -> Schedule:
+    if rotation_table is not None and \
+            (schedule := _projected_window(rotation_table, stage, block, _rotation_window())) is not None:
+        return schedule
+    return _fetched_schedule(stage, block)
+
+
+def _fetched_schedule(stage: int, block: str) -> Schedule:
+    if offline_snapshot is not None:
+        return offline_snapshot.schedule(stage, block)
+    if (schedule := _cached_schedule(stage, block)) is None:
+        if (schedule := fetch_schedule(stage, block)) is not None:
+            schedule_cache.put((stage, block), schedule)
+        elif (schedule := schedule_cache.get_stale((stage, block))) is not None:
+            logging.warning(f'Using expired schedule of stage {stage} block {block} from '
+                            f'{schedule_cache.age((stage, block)):.0f}s ago.')
+        else:
+            schedule = Schedule()
+    return schedule
+
+
+def _cached_schedule(stage: int, block: str) -> Schedule:
+    """ Schedule cached within ttl, for followers of a shared backend any stored one, the leader refreshes it. """
+    if (schedule := schedule_cache.get((stage, block))) is None and not is_leader():
+        schedule = schedule_cache.get_stale((stage, block))
+    return schedule
+
+
+def get_schedule_age(stage: int, block: str) -> float:
+    """ Seconds since the schedule of stage and block was fetched, None if unknown. """
+    if rotation_table is not None and rotation_table.get(stage, block):
+        return time() - rotation_table.created
+    if offline_snapshot is not None:
+        return time() - offline_snapshot.created
+    return schedule_cache.age((stage, block))
+
+
+def _block_schedule(stage: int,
+                    block_id: str,
+                    from_date: datetime = None,
+                    days: int = 7,
+                    full_schedule: Schedule = None) -> Dict:
+    if not from_date:
+        from_date = datetime.now().replace(tzinfo=timezone.utc, hour=0, minute=0, second=0).astimezone(tz=None)
+    from_timestamp = ceil(from_date.timestamp())
+    to_timestamp = floor((from_date + timedelta(days=days)).timestamp())
+    # The rotation covers any date range, the full schedule only what upstream returned
+    if (schedule := _projected(stage, block_id, from_timestamp, to_timestamp)) is None:
+        schedule = full_schedule if full_schedule is not None else get_full_schedule(stage, block_id)
+    return {'block': block_id,
+            'stage': stage,
+            'age': get_schedule_age(stage, block_id),
+            'schedule': [{'level': f'Stage{stage}',
+                          'id': slot_id,
+                          'start': to_datetime(start),
+                          'end': to_datetime(end)}
+                         for start, end, slot_id in schedule.range(from_timestamp, to_timestamp)]}
 
 
 def get_schedule(stage: int,
                  name: str = None,
                  block: str = None,
                  from_date: datetime = None,
-                 days: int = 7) -> [Dict]:
+                 days: int = 7) -> Dict:
     if not name and not block:
         raise ValueError("Provide name or block id")
-    block_id = get_block(name=name, block=block)
-    if not from_date:
-        from_date = datetime.now().replace(tzinfo=timezone.utc, hour=0, minute=0, second=0).astimezone(tz=None)
-    to_datetime = lambda s: datetime.strptime(s, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).astimezone(tz=None)
-    schedule = http_get(API_GET_SCHEDULE.format(block=block_id, stage=stage),
-                        lambda res: [{'level': r['Title'],
-                                      'id': r['ID'],
-                                      'start': to_datetime(r['EventDate']),
-                                      'end': to_datetime(r['EndDate'])}
-                                     for r in res['d']['results']],
-                        {'d': {'results': []}})
-    sorted(schedule, key=lambda s: s['start'])
-    to_date = from_date + timedelta(days=days)
-    return {'block': block_id,
-            'stage': stage,
-            'schedule': [s for s in schedule if from_date <= s['start'] <= to_date]}
+    return _block_schedule(stage, get_block(name=name, block=block), from_date, days)
+
+
+def get_schedules(queries: Iterable[Dict], from_date: datetime = None, workers: int = SCHEDULE_WORKERS) -> [Dict]:
+    """
+    Schedules of {'stage', 'name' or 'block', 'days'} queries, in query order. Each distinct
+    (stage, block) is loaded once, concurrently. A failed query returns {'error': message}
+    instead of a schedule.
+    """
+    resolved = []
+    for query in queries:
+        try:
+            if not isinstance(query, dict) or 'stage' not in query:
+                raise ValueError('Provide stage and name or block id')
+            if not query.get('name') and not query.get('block'):
+                raise ValueError('Provide name or block id')
+            resolved.append((int(query['stage']),
+                             get_block(name=query.get('name'), block=query.get('block')),
+                             int(query.get('days', 7))))
+        except (TypeError, ValueError) as e:
+            resolved.append(e)
+    keys = {(r[0], r[1]) for r in resolved if isinstance(r, tuple)}
+    for stage in {stage for stage, _ in keys}:
+        warm_schedules(stage, [block for s, block in keys if s == stage])
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(keys))),
+                            thread_name_prefix='salsa-schedules') as executor:
+        futures = {key: executor.submit(get_full_schedule, *key) for key in keys}
+    results = []
+    for r in resolved:
+        try:
+            if isinstance(r, Exception):
+                raise r
+            stage, block_id, days = r
+            results.append(_block_schedule(stage, block_id, from_date, days, futures[(stage, block_id)].result()))
+        except Exception as e:
+            results.append({'error': str(e)})
+    return results
+
+
+_outage_indexes = {}
+_outage_locks = {}
+_outage_lock = Lock()
+
+
+def _current_outage_index(stage: int) -> OutageIndex:
+    entry = _outage_indexes.get(stage)
+    if entry and entry[0] == (schedule_cache.version, rotation_table) and \
+            monotonic() - entry[1] < schedule_cache.ttl:
+        return entry[2]
+    return None
+
+
+def _cached_or_stale(stage: int, block: str) -> Schedule:
+    if (schedule := schedule_cache.get((stage, block))) is None:
+        schedule = schedule_cache.get_stale((stage, block))
+    return schedule
+
+
+def get_outage_index(stage: int) -> OutageIndex:
+    """ Outage index over all blocks of stage, rebuilt when the schedule cache changes or expires. """
+    with _outage_lock:
+        lock = _outage_locks.setdefault(stage, Lock())
+    if (index := _current_outage_index(stage)) is not None:
+        return index
+    blocks = suburb_index.blocks
+    # Upstream requests are made outside the locks, a slow stage does not hold up others
+    warm_schedules(stage, blocks)
+    with lock:
+        if (index := _current_outage_index(stage)) is not None:
+            return index
+        version = (schedule_cache.version, rotation_table)
+        if rotation_table is not None:
+            lookup = lambda stage, block: get_full_schedule(stage, block) if rotation_table.get(stage, block) \
+                else _cached_or_stale(stage, block)
+        elif offline_snapshot is not None:
+            lookup = offline_snapshot.schedule
+        else:
+            lookup = _cached_or_stale
+        index = OutageIndex({block: schedule for block in blocks
+                             if (schedule := lookup(stage, block)) is not None})
+        _outage_indexes[stage] = (version, monotonic(), index)
+        return index
+
+
+def get_outages(stage: int, at: datetime = None, until: datetime = None) -> Dict:
+    """ Blocks and suburbs with an outage at time at, or within window at..until. """
+    at = at or datetime.now().astimezone(tz=None)
+    until = until or at
+    slots = get_outage_index(stage).between(floor(at.timestamp()), floor(until.timestamp())) if stage > 0 else []
+    return {'stage': stage,
+            'from': at,
+            'to': until,
+            'outages': [{'block': block,
+                         'start': to_datetime(start),
+                         'end': to_datetime(end),
+                         'suburbs': [s['title'] for s in suburb_index.by_block(block)]}
+                        for block, start, end in sorted(slots)]}
+
+
+def compile_snapshot(path: str = SNAPSHOT_FILE, stages: [int] = PREFETCH_STAGES) -> Dict[int, int]:
+    """ Write suburbs and schedules of all blocks and stages to a snapshot file. Returns blocks per stage. """
+    if offline_snapshot is not None:
+        raise ValueError('Snapshot can not be compiled in offline mode')
+    suburbs = get_suburbs()
+    prefetch(stages)
+    blocks = suburb_index.blocks
+    schedules = [(stage, block, get_full_schedule(stage, block)) for stage in stages for block in blocks]
+    write_snapshot(path, suburbs, schedules, stage=current if (current := get_stage()) >= 0 else None)
+    return {stage: sum(1 for s, _, schedule in schedules if s == stage and schedule) for stage in stages}
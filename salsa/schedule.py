@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+schedule.py - Compact outage schedule of one (stage, block)
+"""
+
+from typing import Dict, Iterable, Iterator, Tuple
+from array import array
+from bisect import bisect_left, bisect_right
+from calendar import timegm
+from datetime import datetime, timezone
+
+
+def parse_timestamp(date: str) -> int:
+    """ Epoch seconds of an upstream '%Y-%m-%dT%H:%M:%SZ' UTC date. """
+    return timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                   int(date[11:13]), int(date[14:16]), int(date[17:19])))
+
+
+def to_datetime(timestamp: int) -> datetime:
+    return datetime.fromtimestamp(timestamp, timezone.utc).astimezone(tz=None)
+
+
+class Schedule(object):
+    """
+    Outage slots sorted by start time, held as epoch second arrays.
+    Range queries are binary searches on starts.
+    """
+
+    __slots__ = ('starts', 'ends', 'ids')
+
+    def __init__(self, slots: Iterable[Tuple[int, int, int]] = ()):
+        ordered = sorted(slots)
+        self.starts = array('q', (s[0] for s in ordered))
+        self.ends = array('q', (s[1] for s in ordered))
+        self.ids = array('q', (s[2] for s in ordered))
+
+    @staticmethod
+    def from_records(records: Iterable[Dict]) -> 'Schedule':
+        return Schedule((parse_timestamp(r['EventDate']), parse_timestamp(r['EndDate']), r['ID'])
+                        for r in records)
+
+    @staticmethod
+    def from_arrays(starts: array, ends: array, ids: array) -> 'Schedule':
+        """ Schedule of already sorted slot arrays, without copying. """
+        schedule = Schedule()
+        schedule.starts, schedule.ends, schedule.ids = starts, ends, ids
+        return schedule
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def range(self, from_timestamp: int, to_timestamp: int) -> Iterator[Tuple[int, int, int]]:
+        """ Slots with from_timestamp <= start <= to_timestamp. """
+        i = bisect_left(self.starts, from_timestamp)
+        j = bisect_right(self.starts, to_timestamp, lo=i)
+        return zip(self.starts[i:j], self.ends[i:j], self.ids[i:j])
+
+    def to_json(self) -> Dict:
+        return {'start': self.starts.tolist(), 'end': self.ends.tolist(), 'id': self.ids.tolist()}
+
+    @staticmethod
+    def from_json(data: Dict) -> 'Schedule':
+        return Schedule(zip(data['start'], data['end'], data['id']))
+
+    def next(self, timestamp: int) -> Tuple[int, int, int]:
+        """ First slot with end > timestamp, ongoing or upcoming, None if there is none. """
+        i = bisect_right(self.starts, timestamp)
+        if i > 0 and self.ends[i - 1] > timestamp:
+            i -= 1
+        return (self.starts[i], self.ends[i], self.ids[i]) if i < len(self.starts) else None
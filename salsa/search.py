@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+search.py - Ranked fuzzy suburb search over a trigram index
+"""
+
+from typing import Dict, List
+from bisect import bisect_left
+from heapq import nlargest
+import re
+
+
+DEFAULT_LIMIT = 10
+MIN_SCORE = 0.3
+
+_separators = re.compile(r'[^a-z0-9]+')
+
+
+def normalize(text: str) -> str:
+    return _separators.sub(' ', text.lower()).strip()
+
+
+def trigrams(text: str) -> set:
+    """ Trigrams of the words of a normalized text, words are padded to match word starts and ends. """
+    result = set()
+    for word in text.split():
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class SearchIndex(object):
+    """
+    Immutable trigram index over suburb titles. Matches are ranked:
+      1.0        exact title
+      0.9 - 1.0  title prefix
+      0.8 - 0.9  word prefix or substring
+      < 0.8      shared trigrams, tolerates typos like "Roseback"
+    Within a rank shorter titles score higher.
+    """
+
+    def __init__(self, suburbs: [Dict]):
+        self._suburbs = sorted(suburbs, key=lambda s: (normalize(s['title']), s['block']))
+        self._titles = [normalize(s['title']) for s in self._suburbs]
+        self._sizes = []
+        self._postings = {}
+        for i, title in enumerate(self._titles):
+            title_trigrams = trigrams(title)
+            self._sizes.append(len(title_trigrams))
+            for trigram in title_trigrams:
+                self._postings.setdefault(trigram, []).append(i)
+
+    def __len__(self) -> int:
+        return len(self._suburbs)
+
+    def _score(self, query: str, query_size: int, i: int, common: int) -> float:
+        title = self._titles[i]
+        if title == query:
+            return 1.0
+        length_ratio = len(query) / len(title)
+        if title.startswith(query):
+            return 0.9 + 0.1 * length_ratio
+        if query in title:
+            return 0.8 + 0.1 * length_ratio
+        containment = common / query_size
+        dice = 2 * common / (query_size + self._sizes[i])
+        return 0.8 * (containment + dice) / 2
+
+    def suggest(self, query: str, limit: int = DEFAULT_LIMIT, min_score: float = MIN_SCORE) -> List[Dict]:
+        """ Top limit suburbs matching query, best first, with score. """
+        if not (query := normalize(query or '')) or limit <= 0:
+            return []
+        query_trigrams = trigrams(query)
+        candidates = {}
+        for trigram in query_trigrams:
+            for i in self._postings.get(trigram, ()):
+                candidates[i] = candidates.get(i, 0) + 1
+        # Prefix matches of queries ending mid-word share few trigrams, add them from the sorted titles
+        i = bisect_left(self._titles, query)
+        while i < len(self._titles) and self._titles[i].startswith(query):
+            candidates.setdefault(i, 0)
+            i += 1
+        scored = ((self._score(query, len(query_trigrams), i, common), -i) for i, common in candidates.items())
+        # Equal scores rank in title order, i.e. by lower index
+        top = nlargest(limit, (entry for entry in scored if entry[0] >= min_score))
+        return [{**self._suburbs[-negative_index], 'score': round(score, 3)} for score, negative_index in top]
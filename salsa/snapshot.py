@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+snapshot.py - Compiled SQLite snapshot of suburbs and schedules for offline queries
+"""
+
+from typing import Dict, Iterable, Tuple
+from threading import local
+from os import replace, remove
+from os.path import isfile
+from time import time
+from salsa.schedule import Schedule
+from salsa.search import SearchIndex
+import sqlite3
+
+
+SNAPSHOT_VERSION = 1
+MMAP_SIZE = 64 * 1024 * 1024  # in bytes
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE suburbs (id INTEGER, title TEXT, title_lower TEXT, block TEXT);
+CREATE INDEX suburbs_block ON suburbs (block, title);
+CREATE INDEX suburbs_title ON suburbs (title);
+CREATE TABLE schedules (stage INTEGER, block TEXT, start INTEGER, end INTEGER, id INTEGER,
+                        PRIMARY KEY (stage, block, start, id)) WITHOUT ROWID;
+'''
+
+
+def write_snapshot(path: str,
+                   suburbs: [Dict],
+                   schedules: Iterable[Tuple[int, str, Schedule]],
+                   stage: int = None):
+    """ Write suburbs and (stage, block, schedule) items to a new snapshot file, replacing path atomically. """
+    tmp_path = f'{path}.tmp'
+    if isfile(tmp_path):
+        remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.executescript(SCHEMA)
+        connection.executemany('INSERT INTO meta VALUES (?, ?)',
+                               [('version', str(SNAPSHOT_VERSION)),
+                                ('created', str(int(time()))),
+                                ('stage', None if stage is None else str(stage))])
+        connection.executemany('INSERT INTO suburbs VALUES (?, ?, ?, ?)',
+                               [(s['id'], s['title'], s['title'].lower(), s['block']) for s in suburbs])
+        connection.executemany('INSERT OR IGNORE INTO schedules VALUES (?, ?, ?, ?, ?)',
+                               ((stage, block, start, end, slot_id)
+                                for stage, block, schedule in schedules
+                                for start, end, slot_id in zip(schedule.starts, schedule.ends, schedule.ids)))
+        connection.commit()
+        connection.execute('VACUUM')
+    finally:
+        connection.close()
+    replace(tmp_path, path)
+
+
+class Snapshot(object):
+    """
+    Read-only view of a snapshot file. Rows are read on demand through a memory-mapped,
+    per-thread SQLite connection, so opening is cheap and nothing is loaded up front.
+    Provides the SuburbIndex lookup API.
+    """
+
+    def __init__(self, path: str):
+        if not isfile(path):
+            raise ValueError(f'Snapshot file {path} does not exist, run: python -m salsa compile')
+        self._path = path
+        self._local = local()
+        self._search = None
+        if (version := self._meta('version')) != str(SNAPSHOT_VERSION):
+            raise ValueError(f'Snapshot file {path} has unsupported version {version}')
+
+    def _connection(self) -> sqlite3.Connection:
+        if (connection := getattr(self._local, 'connection', None)) is None:
+            connection = sqlite3.connect(f'file:{self._path}?mode=ro&immutable=1', uri=True,
+                                         check_same_thread=False)
+            connection.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+            self._local.connection = connection
+        return connection
+
+    def _meta(self, key: str) -> str:
+        row = self._connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def created(self) -> int:
+        return int(self._meta('created'))
+
+    @property
+    def stage(self) -> int:
+        """ Stage at compile time, -5 (upstream error) if unknown. """
+        return int(stage) if (stage := self._meta('stage')) is not None else -5
+
+    def _suburbs(self, where: str = '', args: Tuple = ()) -> [Dict]:
+        return [{'title': title, 'id': suburb_id, 'block': block}
+                for suburb_id, title, block in self._connection().execute(
+                    f'SELECT id, title, block FROM suburbs {where} ORDER BY title', args)]
+
+    @property
+    def suburbs(self) -> [Dict]:
+        return self._suburbs()
+
+    @property
+    def blocks(self) -> [str]:
+        return [row[0] for row in self._connection().execute('SELECT DISTINCT block FROM suburbs')]
+
+    def has_block(self, block: str) -> bool:
+        return self._connection().execute('SELECT 1 FROM suburbs WHERE block = ? LIMIT 1', (block,)) \
+                   .fetchone() is not None
+
+    def by_block(self, block: str) -> [Dict]:
+        return self._suburbs('WHERE block = ?', (block,))
+
+    def by_name(self, name: str) -> [Dict]:
+        pattern = name.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return self._suburbs("WHERE title_lower LIKE ? ESCAPE '\\'", (f'%{pattern}%',))
+
+    @property
+    def search(self) -> SearchIndex:
+        if (search := self._search) is None:
+            search = self._search = SearchIndex(self.suburbs)
+        return search
+
+    def reload(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def schedule(self, stage: int, block: str) -> Schedule:
+        return Schedule(self._connection().execute(
+            'SELECT start, end, id FROM schedules WHERE stage = ? AND block = ?', (stage, block)))
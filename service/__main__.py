@@ -4,6 +4,10 @@ from service.service import start_server
 from service.mqtt import start_notifier, cleanup_notifier
 from service.schedule_controller import start_schedule_controller
 from service.utils import Config
+from salsa import salsa
+from salsa.backend import MemoryBackend, SQLiteBackend, LEASE_TTL
+from salsa import profiling
+from threading import Thread
 import logging
 import argparse
 
@@ -23,6 +27,17 @@ parser.add_argument('-p', '--port',
                     type=int,
                     default=8080,
                     help='HTTP service port')
+parser.add_argument('-o', '--offline',
+                    action='store_true',
+                    help='Serve from snapshot file without upstream requests')
+parser.add_argument('-s', '--snapshot',
+                    action='store',
+                    type=str,
+                    default=None,
+                    help='Snapshot file for offline mode')
+parser.add_argument('--profile',
+                    action='store_true',
+                    help='Profile slow requests and controller cycles, see /api/debug/profile')
 args = parser.parse_args()
 
 
@@ -35,15 +50,50 @@ if __name__ == '__main__':
                         datefmt='%Y-%m-%d %H:%M:%S',
                         level=logging.getLevelName(config('logging', 'level')))
     logging.info('Initialising Salsa service')
-    mqtt_client = start_notifier(config)
-    schedule_controller = start_schedule_controller(config, mqtt_client) if mqtt_client else None
+    salsa.http_client.connect_timeout = config('salsa', 'connect_timeout') or salsa.HTTP_CONNECT_TIMEOUT
+    salsa.http_client.read_timeout = config('salsa', 'read_timeout') or salsa.HTTP_READ_TIMEOUT
+    salsa.http_client.retries = config('salsa', 'retries') if config('salsa', 'retries') is not None \
+        else salsa.HTTP_RETRIES
+    salsa.http_client.breaker_threshold = config('salsa', 'breaker_threshold') or salsa.BREAKER_THRESHOLD
+    salsa.http_client.breaker_timeout = config('salsa', 'breaker_timeout') or salsa.BREAKER_TIMEOUT
+    salsa.stage_cache.ttl = config('salsa', 'stage_ttl') or salsa.STAGE_CACHE_TTL
+    salsa.stage_cache.stale_ttl = config('salsa', 'stage_stale_ttl') or salsa.STAGE_CACHE_STALE_TTL
+    salsa.stage_cache.snapshot_file = config('salsa', 'stage_cache_file') or salsa.STAGE_CACHE_FILE
+    salsa.schedule_cache.ttl = config('salsa', 'schedule_ttl') or salsa.SCHEDULE_CACHE_TTL
+    salsa.schedule_cache.max_entries = config('salsa', 'schedule_cache_size') or salsa.SCHEDULE_CACHE_SIZE
+    salsa.schedule_cache.snapshot_file = config('salsa', 'schedule_cache_file') or salsa.SCHEDULE_CACHE_FILE
+    if args.profile or config('profile', 'enabled'):
+        profiling.profiler.enable(mode=config('profile', 'mode') or profiling.CPROFILE,
+                                  threshold=config('profile', 'threshold') if config('profile', 'threshold') is not None
+                                  else profiling.THRESHOLD,
+                                  interval=config('profile', 'interval') or profiling.SAMPLE_INTERVAL,
+                                  max_records=config('profile', 'max_records') or profiling.MAX_RECORDS,
+                                  directory=config('profile', 'directory'))
+    if config('salsa', 'backend') == 'sqlite':
+        salsa.use_backend(SQLiteBackend(config('salsa', 'backend_file') or 'salsa-cache.db',
+                                        lease_ttl=config('salsa', 'lease_ttl') or LEASE_TTL))
+    elif config('salsa', 'backend') == 'memory':
+        salsa.use_backend(MemoryBackend())
+    if args.offline or config('salsa', 'offline'):
+        snapshot = args.snapshot or config('salsa', 'snapshot') or salsa.SNAPSHOT_FILE
+        logging.info(f'Offline mode, serving from snapshot {snapshot}')
+        salsa.use_snapshot(snapshot)
+    elif config('salsa', 'prefetch') and salsa.is_leader():
+        Thread(target=salsa.prefetch, name='Schedule prefetch', daemon=True).start()
+    if config('salsa', 'rotation'):
+        # Upstream schedules are used until the rotation is loaded or learned
+        Thread(target=salsa.use_rotation, args=(config('salsa', 'rotation_file') or salsa.ROTATION_FILE,),
+               name='Rotation', daemon=True).start()
+    notifier = start_notifier(config)
+    schedule_controller = start_schedule_controller(config, notifier) \
+        if notifier or config('server', 'events') else None
 
     def terminate():
         logging.info('Service terminate called.')
         if schedule_controller:
             schedule_controller.stop()
-        if mqtt_client:
-            cleanup_notifier(mqtt_client)
+        if notifier:
+            cleanup_notifier(notifier)
 
     try:
         start_server(config, terminate)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from typing import Any, Dict, List, Tuple
+from collections import deque
+from threading import Condition
+from json import dumps, loads
+
+
+HISTORY_SIZE = 1024
+
+
+class Broadcaster(object):
+    """
+    In-process broadcast of controller notifications to HTTP subscribers.
+    Events get increasing ids and are kept in a bounded history, so subscribers
+    resume from their last seen id. Like MQTT retain, the last event per topic
+    is kept for new subscribers.
+    """
+
+    def __init__(self, history: int = HISTORY_SIZE):
+        self._condition = Condition()
+        self._events = deque(maxlen=history)
+        self._retained = {}
+        self._last_id = 0
+
+    def publish(self, topic: str, payload: Any, retain: bool = True):
+        try:
+            data = loads(payload) if isinstance(payload, (str, bytes)) else payload
+        except ValueError:
+            data = payload
+        with self._condition:
+            self._last_id += 1
+            event = {'id': self._last_id, 'event': topic.rsplit('/', 1)[-1], 'topic': topic, 'data': data}
+            self._events.append(event)
+            if retain:
+                self._retained[topic] = event
+            self._condition.notify_all()
+
+    def retained(self) -> Tuple[List[Dict], int]:
+        """ Last event per retained topic and the current last event id. """
+        with self._condition:
+            return sorted(self._retained.values(), key=lambda e: e['id']), self._last_id
+
+    def _since(self, last_id: int) -> List[Dict]:
+        if not self._events or self._events[-1]['id'] <= last_id:
+            return []
+        if self._events[0]['id'] > last_id + 1:
+            # Subscriber fell behind history, resync with retained state
+            return sorted(self._retained.values(), key=lambda e: e['id'])
+        return [e for e in self._events if e['id'] > last_id]
+
+    def wait(self, last_id: int, timeout: float) -> List[Dict]:
+        """ Events after last_id, waits up to timeout seconds for new ones. """
+        with self._condition:
+            if last_id > self._last_id:
+                # Id from before a service restart
+                return sorted(self._retained.values(), key=lambda e: e['id'])
+            self._condition.wait_for(lambda: self._last_id > last_id, timeout=timeout)
+            return self._since(last_id)
+
+
+def sse_message(event: Dict) -> bytes:
+    return f'id: {event["id"]}\nevent: {event["event"]}\ndata: {dumps(event)}\n\n'.encode('utf-8')
+
+
+broadcaster = Broadcaster()
@@ -2,13 +2,165 @@
 
 import logging
 import paho.mqtt.client as mqtt
+from typing import Any, Dict
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import RLock
+
+
+MAX_IN_FLIGHT = 100
+DEFAULT_TOPIC_OPTIONS = {
+    'stage': {'qos': 0, 'retain': True, 'dedupe': True},
+    'schedule': {'qos': 0, 'retain': True, 'dedupe': True},
+    'alert': {'qos': 0, 'retain': True, 'dedupe': False},
+    'metrics': {'qos': 0, 'retain': False, 'dedupe': False},
+    'status': {'qos': 0, 'retain': False, 'dedupe': False},
+}
+
+
+class Notifier(object):
+    """
+    Publishes through the MQTT client with per topic QoS and retain, options are looked up
+    by the last topic level and can be overridden with mqtt.topics in config.
+    State topics (dedupe) skip payloads equal to the last published one, unless forced.
+    At most max_in_flight messages are handed to the client until acknowledged by on_publish,
+    further messages wait in a pending queue holding only the latest payload per topic.
+    The lock is never held while calling the client, whose callbacks run under paho's locks.
+    Publishes inside batch() are coalesced per topic and sent when the batch ends.
+    """
+
+    def __init__(self, client: mqtt.Client, config):
+        self.client = client
+        self._lock = RLock()
+        self._last = {}
+        self._in_flight = {}
+        self._sending = 0
+        self._acknowledged = set()
+        self._pending = OrderedDict()
+        self._batch = None
+        self._options = {**DEFAULT_TOPIC_OPTIONS}
+        for topic, options in (config('mqtt', 'topics') or {}).items():
+            self._options[topic] = {**self._options.get(topic, {}), **options}
+        self.max_in_flight = config('mqtt', 'max_in_flight') or MAX_IN_FLIGHT
+        client.on_publish = self._on_publish
+
+    @property
+    def on_message(self):
+        return self.client.on_message
+
+    @on_message.setter
+    def on_message(self, callback):
+        self.client.on_message = callback
+
+    def options(self, topic: str) -> Dict[str, Any]:
+        return {'qos': 0, 'retain': True, 'dedupe': False, **self._options.get(topic.rsplit('/', 1)[-1], {})}
+
+    def reset(self):
+        """
+        Forget last published payloads and messages in flight after reconnect, the broker may not
+        have retained state and acknowledgements of the previous connection do not arrive.
+        """
+        with self._lock:
+            self._last.clear()
+            self._in_flight.clear()
+            self._acknowledged.clear()
+        self._send_pending()
+
+    @contextmanager
+    def batch(self):
+        with self._lock:
+            outer = self._batch is not None
+            if not outer:
+                self._batch = OrderedDict()
+        try:
+            yield self
+        finally:
+            if not outer:
+                with self._lock:
+                    batch, self._batch = self._batch, None
+                for topic, (payload, force) in batch.items():
+                    self.publish(topic, payload, force=force)
+
+    def publish(self, topic: str, payload: Any, force: bool = False) -> bool:
+        """ Publish payload, returns False if skipped as unchanged. """
+        payload = str(payload)
+        options = self.options(topic)
+        with self._lock:
+            if self._batch is not None:
+                self._batch[topic] = (payload, force or self._batch.get(topic, (None, False))[1])
+                self._batch.move_to_end(topic)
+                return True
+            if options['dedupe'] and not force and self._last.get(topic) == payload:
+                logging.debug(f'Skipping unchanged {topic}.')
+                return False
+            self._last[topic] = payload
+            if self.in_flight >= self.max_in_flight:
+                logging.warning(f'{self.in_flight} messages in flight, queuing {topic}.')
+                self._pending[topic] = payload
+                self._pending.move_to_end(topic)
+                return True
+            self._sending += 1
+        self._send(topic, payload, options)
+        if self._pending:
+            # Slots freed by acknowledgements received while sending
+            self._send_pending()
+        return True
+
+    def _send(self, topic: str, payload: str, options: Dict[str, Any]):
+        """ Hand a message with a reserved in flight slot to the client, never called holding the lock. """
+        # paho calls on_publish and on_connect holding its own locks, which it also takes in publish
+        info = self.client.publish(topic, payload=payload, qos=options['qos'], retain=options['retain'])
+        with self._lock:
+            self._sending -= 1
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # Not acknowledged on this connection, messages with QoS > 0 are resent by the client
+                logging.warning(f'Publishing {topic} failed with {info.rc}.')
+                if self._last.get(topic) == payload:
+                    del self._last[topic]
+            elif info.mid in self._acknowledged:
+                self._acknowledged.discard(info.mid)
+            else:
+                self._in_flight[info.mid] = topic
+
+    def _send_pending(self):
+        """ Send pending messages while in flight slots are free. """
+        while True:
+            with self._lock:
+                messages = []
+                while self._pending and self.in_flight < self.max_in_flight:
+                    messages.append(self._pending.popitem(last=False))
+                    self._sending += 1
+            if not messages:
+                return
+            for topic, payload in messages:
+                self._send(topic, payload, self.options(topic))
+
+    def _on_publish(self, client, user_data, mid):
+        logging.debug(f'Data published with mid {mid}.')
+        with self._lock:
+            if self._in_flight.pop(mid, None) is None and self._sending:
+                # Acknowledged before publish returned
+                self._acknowledged.add(mid)
+        self._send_pending()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight) + self._sending
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
 
 
 def on_connect(client, user_data, flags, rc):
     if rc == 0:
         logging.info(f'Subscribing to MQTT topic {user_data["config"]("mqtt", "topic")}/sync.')
         client.subscribe(f'{user_data["config"]("mqtt", "topic")}/sync')
-        client.publish(f'{user_data["config"]("mqtt", "topic")}/status', payload='online', retain=False)
+        if notifier := user_data.get('notifier'):
+            notifier.reset()
+            notifier.publish(f'{user_data["config"]("mqtt", "topic")}/status', 'online')
+        else:
+            client.publish(f'{user_data["config"]("mqtt", "topic")}/status', payload='online', retain=False)
     else:
         logging.error(f'Unable to establish connection. Status {rc}')
 
@@ -23,10 +175,6 @@ def on_message(client, user_data, message):
     logging.debug(f'Status update on {topic} with status {status}.')
 
 
-def on_publish(client, user_data, mid):
-    logging.debug(f'Data published with mid {mid}.')
-
-
 def create_client(config):
     client = mqtt.Client(config('mqtt', 'client_name'))
     client.username_pw_set(config('mqtt', 'user'), password=config.get('mqtt', 'password'))
@@ -34,20 +182,22 @@ def create_client(config):
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     client.on_message = on_message
-    client.on_publish = on_publish
     client.on_subscribe = lambda c, ud, mid, qos: logging.debug('Subscribed with qos {0}.'.format(qos))
     client.will_set(f'{config("mqtt", "topic")}/status', 'offline', qos=0, retain=False)
     return client
 
 
-def start_notifier(config) -> mqtt.Client:
+def start_notifier(config) -> Notifier:
     if config('mqtt'):
         client = create_client(config)
+        notifier = Notifier(client, config)
+        client.user_data_set({'config': config, 'notifier': notifier})
+        client.max_queued_messages_set(config('mqtt', 'max_queued') or MAX_IN_FLIGHT)
         try:
             logging.info('Starting MQTT notifier.')
             client.connect(config('mqtt', 'broker'), config('mqtt', 'port'))
             client.loop_start()
-            return client
+            return notifier
         except Exception as e:
             logging.error(e)
             logging.exception('Unable to connect to MQTT broker!')
@@ -56,8 +206,8 @@ def start_notifier(config) -> mqtt.Client:
         return None
 
 
-def cleanup_notifier(client: mqtt.Client):
-    if client is not None:
+def cleanup_notifier(notifier: Notifier):
+    if notifier is not None:
         logging.debug('Cleaning up notifier.')
-        client.disconnect()
-        client.loop_stop()
+        notifier.client.disconnect()
+        notifier.client.loop_stop()
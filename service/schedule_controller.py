@@ -1,18 +1,26 @@
 # -*- coding: utf-8 -*-
 
 from threading import Thread, Event
-from typing import Tuple
-from datetime import datetime, timedelta
+from typing import Dict, Tuple
+from datetime import datetime, timedelta, date
+from concurrent.futures import ThreadPoolExecutor, Future
+from itertools import count
 from salsa import salsa
-from time import sleep
+from time import monotonic
 from json import dumps
+from salsa.metrics import registry
+from salsa.profiling import profiled
 from service.utils import PeekPriorityQueue
-import paho.mqtt.client as mqtt
+from service.events import broadcaster
+from queue import Empty
+from service.mqtt import Notifier
+from contextlib import nullcontext
 import logging
 
 
-SLEEP_INTERVAL = 2  # in seconds
 PULL_INTERVAL = 5   # in minutes
+DEFAULT_TOPIC = 'load-shedding'
+MAX_LATENESS = 60   # in seconds, late events are discarded after
 
 ALERT_LOAD_SHEDDING_ON = 'LOAD_SHEDDING_ON'
 ALERT_LOAD_SHEDDING_OFF = 'LOAD_SHEDDING_OFF'
@@ -20,133 +28,330 @@ ALERT_POWER_OUTAGE_ON = 'POWER_OUTAGE_ON'
 ALERT_ROWER_OUTAGE_OFF = 'POWER_OUTAGE_OFF'
 ALERT_POWER_OUTAGE_NOW = 'POWER_OUTAGE_NOW'
 ALERT_POWER_OUTAGE_IN = 'POWER_OUTAGE_IN'
+ALERT_COUNTERS = (5, 10, 15, 30)  # in minutes before power outage
+
+
+alert_lag = registry.histogram('salsa_alert_lag_seconds', 'Alert fire time behind scheduled time.',
+                               buckets=(0.001, 0.01, 0.1, 0.5, 1, 2, 5, 30, 60))
+stage_queries = registry.counter('salsa_controller_stage_queries_total', 'Controller stage queries by result.')
 
 
 def future_event(event_time):
-    diff = event_time.replace(second=0, microsecond=0) - \
-            datetime.now().replace(second=0, microsecond=0).astimezone(tz=None)
-    return diff.total_seconds()
+    return (event_time - datetime.now().astimezone(tz=None)).total_seconds()
+
+
+def block_topics(config) -> Dict[str, str]:
+    """
+    MQTT topic per configured block. A single block publishes to the configured topic,
+    a list of blocks to <topic>/<block>.
+    """
+    topic = config('mqtt', 'topic') or DEFAULT_TOPIC
+    blocks = config('salsa', 'blocks') or config('salsa', 'block')
+    if isinstance(blocks, str):
+        return {blocks.upper(): topic}
+    return {block.upper(): f'{topic}/{block.upper()}' for block in blocks or []}
 
 
-def alert_event(mqtt_client, config):
+def alert_event(publish, topic):
     def builder_function(time, alert, counter=None):
-        start = time - timedelta(minutes=-counter) if counter else time
+        start = time - timedelta(minutes=counter) if counter else time
 
         def event_function():
-            message = dumps({'alert': alert, 'counter': counter})
-            logging.info(f'Publishing /alert {message}')
-            mqtt_client.publish(f'{config("mqtt", "topic")}/alert', payload=message, retain=True)
+            publish(f'{topic}/alert', dumps({'alert': alert, 'counter': counter}))
         return start, event_function
     return builder_function
 
 
+class AlertSet(object):
+    """
+    Schedule payloads and alerts of a stage for all blocks. Alerts are keyed by
+    (topic, alert, counter, time) with the outage start as value, so sets of
+    different stages can be diffed.
+    """
+
+    def __init__(self, stage: int, blocks: Dict[str, str]):
+        self.stage = stage
+        self.day = date.today()
+        self.schedules = {}
+        self.alerts = {}
+        self.complete = True
+        if stage <= 0:
+            self.schedules = {topic: dumps({'stage': stage, 'schedule': None}) for topic in blocks.values()}
+            return
+        salsa.warm_schedules(stage, list(blocks))
+        for block, topic in blocks.items():
+            try:
+                schedule = salsa.get_schedule(stage, block=block, days=2)
+            except ValueError as e:
+                logging.error(f'Unable to create alerts for block {block}. {e}')
+                self.complete = False
+                continue
+            if salsa.get_schedule_age(stage, schedule['block']) is None:
+                # Neither fetched nor cached, the upstream failed. Blocks without outages are complete.
+                self.complete = False
+            self.schedules[topic] = dumps({'stage': stage,
+                                           'block': schedule['block'],
+                                           'schedule': [{'start': s['start'].isoformat(),
+                                                         'end': s['end'].isoformat()}
+                                                        for s in schedule['schedule']]})
+            for s in schedule['schedule']:
+                start = s['start']
+                self.alerts[(topic, ALERT_POWER_OUTAGE_NOW, None, start)] = start
+                for counter in ALERT_COUNTERS:
+                    self.alerts[(topic, ALERT_POWER_OUTAGE_IN, counter, start)] = start
+                self.alerts[(topic, ALERT_ROWER_OUTAGE_OFF, None, s['end'])] = start
+
+
+def _is_current(future: Future) -> bool:
+    return future.exception() is None and future.result().complete and future.result().day == date.today()
+
+
 def on_syc(controller):
     def on_message(client, user_data, message):
         logging.info('Forcing status update.')
-        controller.query_stage(republish=True)
+        controller.sync()
     return on_message
 
 
 class ScheduleController(Thread):
 
-    def __init__(self, config, mqtt_client: mqtt.Client):
+    def __init__(self, config, notifier: Notifier = None):
         Thread.__init__(self, name='Schedule controller')
-        self._mqtt_client = mqtt_client
-        self._mqtt_client.on_message = on_syc(self)
+        self._notifier = notifier
+        if notifier:
+            self._notifier.on_message = on_syc(self)
         self._config = config
         self._stopper = Event()
+        self._wakeup = Event()
+        self._sync_requested = Event()
         self._event_queue = PeekPriorityQueue()
+        self._event_counter = count()
+        self._blocks = block_topics(config)
         self._stage = -1
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='salsa-alerts')
+        self._stage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='salsa-stage')
+        self._stage_query = None
+        self._alert_sets = {}
+        self._target = None
+        self._applied = None
+        self._scheduled = {}
+        self._cancelled = set()
+        registry.gauge('salsa_controller_queue_depth', 'Queued controller events.',
+                       lambda: self._event_queue.qsize() - len(self._cancelled))
+        registry.gauge('salsa_controller_stage', 'Last stage seen by the controller.', lambda: self._stage)
 
     def stop(self):
         logging.debug('Requesting schedule controller stop.')
         if not self._stopper.is_set():
             self._stopper.set()
+        self._wakeup.set()
         self._clear_queue()
         self.join()
+        self._executor.shutdown(wait=False)
+        self._stage_executor.shutdown(wait=False)
+
+    def sync(self):
+        """ Request stage query and republish from the controller thread. """
+        self._sync_requested.set()
+        self._wakeup.set()
 
-    def _schedule_event(self, event: Tuple):
-        if future_event(event[0]) > 0:
-            self._event_queue.put(event)
+    def _next_deadline(self) -> float:
+        try:
+            return self._event_queue.peek()[0]
+        except Empty:
+            return None
+
+    def _schedule_event(self, event: Tuple, key: Tuple = None) -> int:
+        """ Queue (time, function) event, returns the event id or None for past events. """
+        if (delay := future_event(event[0])) > 0:
+            deadline = monotonic() + delay
+            head = self._next_deadline()
+            seq = next(self._event_counter)
+            self._event_queue.put((deadline, seq, event[0], event[1], key))
+            if head is None or deadline < head:
+                self._wakeup.set()
+            return seq
         else:
-            logging.error(f'Scheduling event for past time {event[0]}')
+            logging.debug(f'Skipping event for past time {event[0]}')
+
+    def _process_events(self):
+        with self._batch():
+            self._process_due_events()
+
+    def _process_due_events(self):
+        while (deadline := self._next_deadline()) is not None and deadline <= monotonic():
+            _, seq, event_time, event_function, key = self._event_queue.get()
+            if seq in self._cancelled:
+                self._cancelled.discard(seq)
+                continue
+            self._scheduled.pop(key, None)
+            if (lateness := monotonic() - deadline) > MAX_LATENESS:
+                logging.warning(f'Past event at {event_time} identified {lateness:.0f}s late. Discarding.')
+            else:
+                event_function()
+                alert_lag.observe(monotonic() - deadline)
 
     def _clear_queue(self):
         while not self._event_queue.empty():
             self._event_queue.get()
+        self._scheduled.clear()
+        self._cancelled.clear()
 
-    def _set_stage(self, stage):
-        self._stage = stage
-        self._clear_queue()
+    def _compact_queue(self):
+        """ Drop cancelled events from the queue. """
+        entries = []
+        while not self._event_queue.empty():
+            if (entry := self._event_queue.get())[1] not in self._cancelled:
+                entries.append(entry)
+        self._cancelled.clear()
+        for entry in entries:
+            self._event_queue.put(entry)
+
+    def _publish(self, topic, payload, force=False):
+        logging.info(f'Publishing {topic} {payload}')
+        if self._notifier:
+            self._notifier.publish(topic, payload, force=force)
+        broadcaster.publish(topic, payload)
+
+    def _batch(self):
+        return self._notifier.batch() if self._notifier else nullcontext()
+
+    def _alert_set(self, stage: int, refresh: bool = False) -> Future:
+        """ Alert set of stage, built in the background. With refresh, outdated or failed sets are rebuilt. """
+        future = self._alert_sets.get(stage)
+        if future is None or (refresh and future.done() and not _is_current(future)):
+            future = self._alert_sets[stage] = self._executor.submit(AlertSet, stage, self._blocks)
+            future.add_done_callback(lambda _: self._wakeup.set())
+        return future
+
+    def _prepare_adjacent(self, stage: int):
+        for adjacent in (stage - 1, stage + 1):
+            if adjacent in salsa.PREFETCH_STAGES:
+                self._alert_set(adjacent, refresh=True)
+
+    @profiled('controller.apply_alerts')
+    def _apply_alerts(self):
+        """ Switch scheduled alerts to the requested stage once its alert set is ready, as a diff. """
+        if self._target is None or not (future := self._alert_sets.get(self._target[0])).done():
+            return
+        stage, republish = self._target
+        self._target = None
+        try:
+            alert_set = future.result()
+        except Exception as e:
+            logging.error(f'Unable to create alerts for stage {stage}. {e}')
+            return
         now = datetime.now().astimezone(tz=None)
-        if stage > 0:
-            logging.info('Creating alerts...')
-            schedule = salsa.get_schedule(stage, block=self._config('salsa', 'block'), days=2)
-            pub_schedule = dumps({'stage': stage,
-                                  'block': schedule['block'],
-                                  'schedule': [{'start': s['start'].isoformat(), 'end': s['end'].isoformat()}
-                                               for s in schedule['schedule']]})
-            logging.info(f'Publishing /schedule {pub_schedule}')
-            self._mqtt_client.publish(f'{self._config("mqtt", "topic")}/schedule', payload=pub_schedule, retain=True)
-            for s in schedule['schedule']:
-                start = s['start']
-                if start > now:
-                    alert_builder = alert_event(self._mqtt_client, self._config)
-                    self._schedule_event(alert_builder(start, ALERT_POWER_OUTAGE_NOW))
-                    self._schedule_event(alert_builder(start, ALERT_POWER_OUTAGE_IN, counter=5))
-                    self._schedule_event(alert_builder(start, ALERT_POWER_OUTAGE_IN, counter=10))
-                    self._schedule_event(alert_builder(start, ALERT_POWER_OUTAGE_IN, counter=15))
-                    self._schedule_event(alert_builder(start, ALERT_POWER_OUTAGE_IN, counter=30))
-                    self._schedule_event(alert_builder(s['end'], ALERT_ROWER_OUTAGE_OFF))
-        elif stage == 0:
-            pub_schedule = dumps({'stage': stage, 'schedule': None})
-            logging.info(f'Publishing /schedule {pub_schedule}')
-            self._mqtt_client.publish(f'{self._config("mqtt", "topic")}/schedule', payload=pub_schedule, retain=True)
+        with self._batch():
+            for topic, payload in alert_set.schedules.items():
+                self._publish(f'{topic}/schedule', payload, force=republish)
+        cancelled = self._scheduled.keys() - alert_set.alerts.keys()
+        for key in cancelled:
+            self._cancelled.add(self._scheduled.pop(key))
+        if len(self._cancelled) > len(self._scheduled):
+            self._compact_queue()
+        added = 0
+        for key, start in alert_set.alerts.items():
+            if key not in self._scheduled and start > now:
+                topic, alert, counter, time = key
+                if (seq := self._schedule_event(alert_event(self._publish, topic)(time, alert, counter),
+                                                   key)) is not None:
+                    self._scheduled[key] = seq
+                    added += 1
+        if alert_set.complete:
+            self._applied = (stage, alert_set.day)
+        logging.info(f'Alerts for stage {stage}: {len(cancelled)} cancelled, {added} added, '
+                     f'{len(self._scheduled)} scheduled.')
 
-    def query_stage(self, republish: bool = False):
+    @profiled('controller.query_stage')
+    def _fetch_stage(self, republish: bool) -> int:
         logging.debug('Requesting load shedding stage.')
-        if (new_stage := salsa.get_stage()) >= 0:
-            logging.info(f'Publishing /stage {new_stage}')
-            self._mqtt_client.publish(f'{self._config("mqtt", "topic")}/stage', payload=new_stage, retain=True)
-            if new_stage != self._stage or republish:
-                message = dumps({'alert': ALERT_LOAD_SHEDDING_ON if new_stage > 0 else ALERT_LOAD_SHEDDING_OFF,
-                                 'counter': None})
-                logging.info(f'Publishing /alert {message}')
-                self._mqtt_client.publish(f'{self._config("mqtt", "topic")}/alert', payload=message, retain=True)
-                self._set_stage(new_stage)
+        return salsa.get_stage(force_fetch=republish)
+
+    def query_stage(self, republish: bool = False):
+        """
+        Query the stage in the background, the upstream call never delays due alerts.
+        The controller thread handles the result when it is woken up.
+        """
+        if self._stage_query is not None and not self._stage_query[0].done():
+            future, pending_republish = self._stage_query
+            self._stage_query = (future, republish or pending_republish)
+            return
+        future = self._stage_executor.submit(self._fetch_stage, republish)
+        self._stage_query = (future, republish)
+        future.add_done_callback(lambda _: self._wakeup.set())
+
+    @profiled('controller.stage_update')
+    def _update_stage(self):
+        """ Publish the stage of a finished query and switch alerts if it changed. """
+        if self._stage_query is None or not self._stage_query[0].done():
+            return
+        future, republish = self._stage_query
+        self._stage_query = None
+        try:
+            new_stage = future.result()
+        except Exception:
+            logging.exception('Load shedding query failed.')
+            new_stage = -1
+        if new_stage >= 0:
+            stage_queries.inc(result='ok')
+            with self._batch():
+                self._publish(f'{self._config("mqtt", "topic") or DEFAULT_TOPIC}/stage', new_stage, force=republish)
+                if new_stage != self._stage or republish:
+                    message = dumps({'alert': ALERT_LOAD_SHEDDING_ON if new_stage > 0 else ALERT_LOAD_SHEDDING_OFF,
+                                     'counter': None})
+                    for topic in self._blocks.values():
+                        self._publish(f'{topic}/alert', message)
+            if new_stage != self._stage or republish or self._applied != (new_stage, date.today()):
+                self._stage = new_stage
+                self._target = (new_stage, republish or (self._target is not None and self._target[1]))
+                self._alert_set(new_stage, refresh=True)
+            self._prepare_adjacent(new_stage)
         else:
+            stage_queries.inc(result='error')
             logging.error(f'Load shedding query returned with error code {new_stage}')
 
+    def publish_metrics(self):
+        if not self._notifier:
+            return
+        topic = f'{self._config("mqtt", "topic")}/metrics'
+        logging.debug(f'Publishing {topic}')
+        self._notifier.publish(topic, dumps(registry.snapshot()))
+
     def run(self):
         logging.info('Starting scheduler controller.')
-        interval = self._config('salsa', 'interval') or PULL_INTERVAL
-        self.query_stage()
+        interval = (self._config('salsa', 'interval') or PULL_INTERVAL) * 60
+        metrics_interval = self._config('mqtt', 'metrics_interval')
+        next_poll = monotonic()
+        next_metrics = monotonic() + metrics_interval if metrics_interval else None
         while not self._stopper.is_set():
-            now = datetime.now().astimezone(tz=None)
-            if now.second < SLEEP_INTERVAL:
-
-                # ping query status
-                if (now.minute % interval) == 0:
-                    self.query_stage()
+            if self._sync_requested.is_set():
+                self._sync_requested.clear()
+                self.query_stage(republish=True)
+                next_poll = monotonic() + interval
+            elif monotonic() >= next_poll:
+                self.query_stage()
+                next_poll = monotonic() + interval
 
-                # remove previous dates
-                while not self._event_queue.empty() and \
-                        future_event(self._event_queue.peek()[0]) < 0:
-                    event = self._event_queue.get()
-                    logging.warning(f'Past event at {event[0]} identified. Discarding.')
+            self._update_stage()
+            self._apply_alerts()
+            self._process_events()
 
-                # process current event
-                while not self._event_queue.empty() and \
-                        future_event(self._event_queue.peek()[0]) == 0:
-                    self._event_queue.get()[1]()
+            if next_metrics is not None and monotonic() >= next_metrics:
+                self.publish_metrics()
+                next_metrics = monotonic() + metrics_interval
 
-            sleep(SLEEP_INTERVAL)
+            deadline = next_poll if next_metrics is None else min(next_poll, next_metrics)
+            if (event_deadline := self._next_deadline()) is not None:
+                deadline = min(deadline, event_deadline)
+            self._wakeup.wait(max(0.0, deadline - monotonic()))
+            self._wakeup.clear()
 
         logging.info('Scheduler controller stopped.')
 
 
-def start_schedule_controller(config, mqtt_client):
-    schedule_controller = ScheduleController(config, mqtt_client)
+def start_schedule_controller(config, notifier):
+    schedule_controller = ScheduleController(config, notifier)
     schedule_controller.start()
     return schedule_controller
 
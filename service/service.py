@@ -2,9 +2,87 @@
 
 import cherrypy
 import logging
-from typing import Dict, Callable
+from cherrypy.lib import cptools
+from typing import Dict, Callable, Tuple
 from pathlib import Path
+from datetime import datetime, timedelta
+from time import monotonic
 from salsa import salsa
+from salsa.metrics import registry
+from salsa.profiling import profiler
+from service.utils import Payload, PayloadCache
+from service.events import broadcaster, sse_message
+from threading import BoundedSemaphore
+from json import dumps
+
+
+GZIP_MIN_SIZE = 1024      # in bytes
+SUBURBS_MAX_AGE = 3600    # in seconds
+OUTAGES_MAX_AGE = 60      # in seconds
+SUGGEST_MAX_LIMIT = 50
+SCHEDULE_BATCH_MAX = 200  # queries per request
+EVENTS_HEARTBEAT = 5      # in seconds, a disconnected stream is noticed at the next write
+EVENTS_POLL_TIMEOUT = 25  # in seconds
+EVENTS_RETRY_AFTER = 30   # in seconds, when all event streams are taken
+PROFILE_TEXT_LIMIT = 40   # functions listed in text profiles
+
+
+def accepts_gzip() -> bool:
+    return any(e.value == 'gzip' for e in cherrypy.request.headers.elements('Accept-Encoding'))
+
+
+def serve(payload: Payload, max_age: float = None) -> bytes:
+    """
+    Serve pre-serialized payload with caching headers, 304 on matching If-None-Match.
+    Without max_age, e.g. for POST responses, the payload is not cached and has no ETag.
+    """
+    headers = cherrypy.response.headers
+    headers['Vary'] = 'Accept-Encoding'
+    gzipped = len(payload.body) >= GZIP_MIN_SIZE and accepts_gzip()
+    if max_age is None:
+        headers['Cache-Control'] = 'no-store'
+    else:
+        headers['Cache-Control'] = f'public, max-age={max(0, int(max_age))}'
+        headers['ETag'] = f'{payload.etag[:-1]}-gzip"' if gzipped else payload.etag
+        cptools.validate_etags()
+    if gzipped:
+        headers['Content-Encoding'] = 'gzip'
+        return payload.gzipped
+    return payload.body
+
+
+api_latency = registry.histogram('salsa_api_request_seconds', 'API request latency by route and status.')
+
+
+def record_request_latency():
+    request = cherrypy.request
+    start = monotonic()
+
+    def observe():
+        status = str(cherrypy.response.status or 200).split(' ')[0]
+        route = request.path_info.rstrip('/') if status != '404' else 'unknown'
+        api_latency.observe(monotonic() - start, route=route, status=status)
+    request.hooks.attach('on_end_request', observe)
+
+
+cherrypy.tools.metrics = cherrypy.Tool('on_start_resource', record_request_latency)
+
+
+def profile_handler():
+    request = cherrypy.request
+    if not profiler.enabled or (handler := request.handler) is None:
+        return
+    name = f'{request.method} {request.path_info.rstrip("/")}'
+    request.handler = lambda *args, **kwargs: profiler.call(name, handler, *args, **kwargs)
+
+
+# After json_in and json_out so their (de)serialization is part of the profile
+cherrypy.tools.profile = cherrypy.Tool('before_handler', profile_handler, priority=90)
+
+
+def seconds_to_midnight() -> float:
+    now = datetime.now()
+    return (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
 
 
 class App(object):
@@ -25,68 +103,279 @@ class Api(object):
 @cherrypy.expose
 class ApiList(object):
 
-    @cherrypy.tools.json_out()
-    def GET(self, reload: bool = False) -> Dict[str, object]:
-        return salsa.get_suburbs(reload)
+    def __init__(self):
+        self._payloads = PayloadCache(max_entries=1)
+
+    def GET(self, reload: bool = False) -> bytes:
+        suburbs = salsa.reload_suburbs(force_fetch=True) if reload else salsa.get_suburbs()
+        return serve(self._payloads.get('list', suburbs, lambda: suburbs), SUBURBS_MAX_AGE)
 
 
 @cherrypy.expose
 class ApiFind(object):
 
-    @cherrypy.tools.json_out()
-    def GET(self, name: str = None, block: str = None) -> Dict[str, object]:
-        return salsa.find_suburb(name=name, block=block)
+    def GET(self, name: str = None, block: str = None) -> bytes:
+        return serve(Payload(salsa.find_suburb(name=name, block=block)), SUBURBS_MAX_AGE)
+
+
+@cherrypy.expose
+class ApiSuggest(object):
+    """ Type-ahead suburb search, ranked fuzzy matches of q. """
+
+    def __init__(self):
+        self._payloads = PayloadCache()
+
+    def GET(self, q: str = '', limit: int = 10) -> bytes:
+        query, limit = q.strip().lower(), max(0, min(int(limit), SUGGEST_MAX_LIMIT))
+        search = salsa.suburb_index.search
+        return serve(self._payloads.get((query, limit), search, lambda: search.suggest(query, limit)),
+                     SUBURBS_MAX_AGE)
 
 
 @cherrypy.expose
 class ApiSchedule(object):
 
-    @cherrypy.tools.json_out()
-    def GET(self, stage: int, name: str = None, block: str = None, days: int = 7) -> Dict[str, object]:
-        schedule = salsa.get_schedule(stage, name=name, block=block, days=days)
-        return {'stage': stage,
-                'suburb': name,
-                'block': block,
-                'schedule': [{'start': s['start'].isoformat(), 'end': s['end'].isoformat()}
-                             for s in schedule['schedule']]}
+    def __init__(self):
+        self._payloads = PayloadCache()
+
+    def GET(self, stage: int, name: str = None, block: str = None, days: int = 7) -> bytes:
+        stage, days = int(stage), int(days)
+        block_id = salsa.get_block(name=name, block=block)
+
+        def build():
+            schedule = salsa.get_schedule(stage, block=block_id, days=days)
+            return {'stage': stage,
+                    'suburb': name,
+                    'block': block,
+                    'schedule': [{'start': s['start'].isoformat(), 'end': s['end'].isoformat()}
+                                 for s in schedule['schedule']]}
+
+        payload = self._payloads.get((stage, name, block, days, datetime.now().date()),
+                                     salsa.get_full_schedule(stage, block_id),
+                                     build)
+        if (age := salsa.get_schedule_age(stage, block_id)) is not None:
+            cherrypy.response.headers['Age'] = str(int(age))
+        return serve(payload, min(salsa.schedule_cache.ttl, seconds_to_midnight()))
+
+
+@cherrypy.expose
+class ApiScheduleBatch(object):
+    """
+    Schedules of many queries in one request. POST a JSON list of
+    {"stage": <1..8>, "name": <suburb name> or "block": <block id>, "days": <days>},
+    results are returned in query order, failed queries as {"error": <message>}.
+    """
+
+    @cherrypy.tools.json_in()
+    def POST(self, **kwargs) -> bytes:
+        queries = cherrypy.request.json
+        if isinstance(queries, dict):
+            queries = queries.get('queries')
+        if not isinstance(queries, list):
+            raise cherrypy.HTTPError(400, 'Expected a JSON list of queries')
+        if len(queries) > SCHEDULE_BATCH_MAX:
+            raise cherrypy.HTTPError(413, f'At most {SCHEDULE_BATCH_MAX} queries per request')
+        results = []
+        for query, schedule in zip(queries, salsa.get_schedules(queries)):
+            if 'error' in schedule:
+                results.append({'error': schedule['error']})
+            else:
+                results.append({'stage': schedule['stage'],
+                                'suburb': query.get('name'),
+                                'block': schedule['block'],
+                                'schedule': [{'start': s['start'].isoformat(), 'end': s['end'].isoformat()}
+                                             for s in schedule['schedule']]})
+        return serve(Payload({'results': results}))
 
 
 @cherrypy.expose
 class ApiStage(object):
 
-    @cherrypy.tools.json_out()
-    def GET(self, **kwargs) -> Dict[str, object]:
-        return {'load_shedding_stage': salsa.get_stage()}
+    def GET(self, **kwargs) -> bytes:
+        stage = salsa.get_stage()
+        age = salsa.get_stage_age()
+        if age is not None:
+            cherrypy.response.headers['Age'] = str(int(age))
+        return serve(Payload({'load_shedding_stage': stage, 'age': None if age is None else int(age)}),
+                     salsa.stage_cache.ttl - (age if age is not None else salsa.stage_cache.ttl))
 
 
-def start_server(config: Dict, terminate: Callable) -> None:
+@cherrypy.expose
+class ApiOutages(object):
+
+    def GET(self, stage: int, at: str = None, until: str = None) -> bytes:
+        at = datetime.fromisoformat(at).astimezone(tz=None) if at else None
+        until = datetime.fromisoformat(until).astimezone(tz=None) if until else None
+        outages = salsa.get_outages(int(stage), at=at, until=until)
+        return serve(Payload({'stage': outages['stage'],
+                              'from': outages['from'].isoformat(),
+                              'to': outages['to'].isoformat(),
+                              'outages': [{**o, 'start': o['start'].isoformat(), 'end': o['end'].isoformat()}
+                                          for o in outages['outages']]}),
+                     OUTAGES_MAX_AGE)
+
+
+@cherrypy.expose
+class ApiEvents(object):
+    """
+    Stage, schedule and alert notifications of the schedule controller. Server-Sent Events
+    if the client accepts text/event-stream, otherwise long-poll for events after since.
+    Streams and long-polls hold a worker thread each, at most max_streams are served at a
+    time so other APIs keep threads, further subscribers get 503 with Retry-After.
+    """
+    _cp_config = {'response.stream': True}
+
+    def __init__(self, max_streams: int):
+        self._streams = BoundedSemaphore(max_streams)
+        self.max_streams = max_streams
+
+    def _acquire_stream(self) -> bool:
+        if not self._streams.acquire(blocking=False):
+            return False
+        # Runs when the response is closed, also after the client disconnected
+        cherrypy.request.hooks.attach('on_end_request', self._streams.release)
+        return True
+
+    @staticmethod
+    def _stream(last_id):
+        if last_id is None:
+            events, last_id = broadcaster.retained()
+            for event in events:
+                yield sse_message(event)
+        while cherrypy.engine.state == cherrypy.engine.states.STARTED:
+            if events := broadcaster.wait(last_id, EVENTS_HEARTBEAT):
+                for event in events:
+                    yield sse_message(event)
+                last_id = events[-1]['id']
+            else:
+                yield b': keepalive\n\n'
+
+    def GET(self, since: int = None, timeout: float = EVENTS_POLL_TIMEOUT, **kwargs):
+        try:
+            since = None if since is None else int(since)
+            timeout = min(float(timeout), EVENTS_POLL_TIMEOUT)
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'since must be an event id and timeout a number of seconds')
+        headers = cherrypy.response.headers
+        headers['Cache-Control'] = 'no-cache'
+        stream = 'text/event-stream' in cherrypy.request.headers.get('Accept', '')
+        if (stream or since is not None) and not self._acquire_stream():
+            # Not raised as HTTPError, which drops Retry-After
+            cherrypy.response.status = 503
+            headers['Retry-After'] = str(EVENTS_RETRY_AFTER)
+            return [dumps({'error': f'All {self.max_streams} event streams are in use'}).encode('utf-8')]
+        if stream:
+            try:
+                last_id = int(cherrypy.request.headers['Last-Event-ID'])
+            except KeyError:
+                last_id = since
+            except ValueError:
+                # Not an id of ours, resync with the retained events
+                last_id = None
+            headers['Content-Type'] = 'text/event-stream'
+            headers['X-Accel-Buffering'] = 'no'
+            return self._stream(last_id)
+        if since is None:
+            events, last_id = broadcaster.retained()
+        else:
+            events = broadcaster.wait(since, timeout)
+            last_id = events[-1]['id'] if events else since
+        return [dumps({'last_id': last_id, 'events': events}).encode('utf-8')]
+
+
+@cherrypy.expose
+class ApiMetrics(object):
+
+    def GET(self, **kwargs) -> bytes:
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return registry.render().encode('utf-8')
+
+
+@cherrypy.expose
+class ApiDebugProfile(object):
+    """
+    Profiles of slow calls while profiling is enabled. Without format a JSON list of the records,
+    otherwise the records of name or id combined as pstats file, text or collapsed stacks.
+    """
+
+    def GET(self, format: str = None, name: str = None, id: str = None, sort: str = 'cumulative') -> bytes:
+        if format is None:
+            return serve(Payload({'enabled': profiler.enabled,
+                                  'mode': profiler.mode,
+                                  'threshold': profiler.threshold,
+                                  'records': [r.to_json() for r in profiler.records(name=name)]}), 0)
+        records = profiler.records(name=name, ids=None if id is None else [int(i) for i in id.split(',')])
+        headers = cherrypy.response.headers
+        if format == 'pstats':
+            if (data := profiler.pstats_data(records)) is None:
+                raise cherrypy.HTTPError(404, 'No cProfile records found')
+            headers['Content-Type'] = 'application/octet-stream'
+            headers['Content-Disposition'] = 'attachment; filename="salsa.prof"'
+            return data
+        if format == 'text':
+            try:
+                body = profiler.text(records, sort, PROFILE_TEXT_LIMIT)
+            except KeyError:
+                raise cherrypy.HTTPError(400, f'Unknown sort key {sort}')
+        elif format == 'collapsed':
+            body = profiler.collapsed(records)
+        else:
+            raise cherrypy.HTTPError(400, 'Format must be one of pstats, text or collapsed')
+        if not body:
+            raise cherrypy.HTTPError(404, f'No {"cProfile" if format == "text" else "sampled"} records found')
+        headers['Content-Type'] = 'text/plain; charset=utf-8'
+        return body.encode('utf-8')
+
+    def DELETE(self, **kwargs) -> bytes:
+        profiler.clear()
+        return serve(Payload({'records': 0}), 0)
+
+
+def create_app(config: Dict) -> Tuple[App, Dict]:
+    """ Application tree and its config. """
     app = App()
     app.api = Api()
     app.api.stage = ApiStage()
     app.api.list = ApiList()
     app.api.find = ApiFind()
+    app.api.suggest = ApiSuggest()
     app.api.schedule = ApiSchedule()
+    app.api.schedule.batch = ApiScheduleBatch()
+    app.api.outages = ApiOutages()
+    app.api.metrics = ApiMetrics()
+    app.api.events = ApiEvents(config('server', 'events_max_streams') or
+                               max(1, (config('server', 'thread_pool') or 10) // 4))
+    if profiler.enabled:
+        app.api.debug = Api()
+        app.api.debug.profile = ApiDebugProfile()
 
     api_config = {
             'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+            'tools.metrics.on': True,
+            'tools.profile.on': True,
             'tools.response_headers.on': True,
             'tools.response_headers.headers': [('Content-Type', 'text/json')]
         }
 
     app_config = {
         '/': {
-            'tools.sessions.on': True,
             'tools.staticdir.root': str(Path('.').resolve().absolute())
         },
         '/api': { **api_config }
     }
+    return app, app_config
+
+
+def start_server(config: Dict, terminate: Callable) -> None:
+    app, app_config = create_app(config)
 
     global_config = {
         'log.screen': False,
         'log.access_file': '',
         'log.error_file': '',
         'server.socket_host': '0.0.0.0',
-        'server.socket_port': config('server', 'port')
+        'server.socket_port': config('server', 'port'),
+        'server.thread_pool': config('server', 'thread_pool') or 10
     }
 
     cherrypy.log.error_log.propagate = False
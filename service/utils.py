@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from typing import Dict, Any
-from json import loads
+from typing import Dict, Any, Callable, Hashable
+from json import loads, dumps
 from pathlib import Path
 from queue import PriorityQueue, Empty
+from collections import OrderedDict
+from threading import Lock
+from hashlib import sha1
+import gzip
 import logging
 
 
@@ -50,3 +54,40 @@ class PeekPriorityQueue(PriorityQueue):
                 return self.queue[0]
         except IndexError:
             raise Empty
+
+
+class Payload(object):
+    """ Pre-serialized JSON response body with ETag and lazily gzipped variant. """
+
+    def __init__(self, data: Any):
+        self.body = dumps(data).encode('utf-8')
+        self.etag = f'"{sha1(self.body).hexdigest()}"'
+        self._gzipped = None
+
+    @property
+    def gzipped(self) -> bytes:
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body)
+        return self._gzipped
+
+
+class PayloadCache(object):
+    """ LRU cache of payloads by request key, an entry is valid while its source object is unchanged. """
+
+    def __init__(self, max_entries: int = 1024):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.max_entries = max_entries
+
+    def get(self, key: Hashable, source: Any, build: Callable[[], Any]) -> Payload:
+        with self._lock:
+            if (entry := self._entries.get(key)) is not None and entry[0] is source:
+                self._entries.move_to_end(key)
+                return entry[1]
+        payload = Payload(build())
+        with self._lock:
+            self._entries[key] = (source, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payload
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import patch
+from salsa.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = patch('salsa.breaker.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=10, max_reset_timeout=25)
+
+    def fail(self, times: int):
+        for _ in range(times):
+            self.breaker.failure()
+
+    def test_opens_after_threshold_consecutive_failures(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.fail(1)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failure_count(self):
+        self.fail(2)
+        self.breaker.success()
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_single_probe_after_reset_timeout(self):
+        self.fail(3)
+        self.now += 9.9
+        self.assertFalse(self.breaker.allow())
+        self.now += 0.1
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_probe_closes(self):
+        self.fail(3)
+        self.now += 10
+        self.breaker.allow()
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_doubles_timeout_up_to_max(self):
+        self.fail(3)
+        for timeout in (20, 25, 25):
+            self.now += 100
+            self.assertTrue(self.breaker.allow())
+            self.breaker.failure()
+            self.assertEqual(self.breaker.state, OPEN)
+            self.now += timeout - 0.1
+            self.assertFalse(self.breaker.allow())
+            self.now -= timeout - 0.1
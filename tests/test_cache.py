@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import patch
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from os.path import join
+from salsa.cache import TTLValue, LRUCache
+from salsa.backend import MemoryBackend
+
+
+class Clock(object):
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TTLValueTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        for name in ('monotonic', 'time'):
+            patcher = patch(f'salsa.cache.{name}', self.clock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.values = []
+        self.calls = 0
+
+    def loader(self):
+        self.calls += 1
+        return self.values.pop(0)
+
+    def test_cached_within_ttl(self):
+        self.values = [1, 2]
+        cache = TTLValue(self.loader, ttl=10)
+        self.assertEqual(cache.get(), 1)
+        self.clock.now += 9
+        self.assertEqual(cache.get(), 1)
+        self.clock.now += 1
+        self.assertEqual(cache.get(), 2)
+        self.assertEqual(self.calls, 2)
+
+    def test_force_fetch_and_invalidate_load(self):
+        self.values = [1, 2, 3]
+        cache = TTLValue(self.loader, ttl=10)
+        cache.get()
+        self.assertEqual(cache.get(force_fetch=True), 2)
+        cache.invalidate()
+        self.assertEqual(cache.get(), 3)
+
+    def test_failed_load_returns_last_valid_value(self):
+        self.values = [1, None]
+        cache = TTLValue(self.loader, ttl=10)
+        cache.get()
+        self.clock.now += 30
+        self.assertEqual(cache.get(), 1)
+        self.assertEqual(cache.age, 30)
+
+    def test_failed_first_load_returns_invalid_result(self):
+        self.values = [-1]
+        cache = TTLValue(self.loader, ttl=10, valid=lambda v: v >= 0)
+        self.assertEqual(cache.get(), -1)
+        self.assertIsNone(cache.age)
+
+    def test_stale_value_returned_while_refreshing(self):
+        self.values = [1, 2]
+        cache = TTLValue(self.loader, ttl=10, stale_ttl=20)
+        cache.get()
+        self.clock.now += 15
+        self.assertEqual(cache.get(), 1)
+        for _ in range(100):
+            if self.calls == 2 and cache.get() == 2:
+                break
+            Event().wait(0.01)
+        self.assertEqual(cache.get(), 2)
+
+    def test_concurrent_misses_load_once(self):
+        started, release = Event(), Event()
+
+        def loader():
+            self.calls += 1
+            started.set()
+            release.wait(5)
+            return 42
+
+        cache = TTLValue(loader, ttl=10)
+        results = []
+        threads = [Thread(target=lambda: results.append(cache.get())) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(self.calls, 1)
+
+    def test_snapshot_restored_by_new_instance(self):
+        with TemporaryDirectory() as directory:
+            path = join(directory, 'value.json')
+            self.values = [7]
+            TTLValue(self.loader, ttl=10, snapshot_file=path).get()
+            self.values = [None]
+            self.clock.now += 100
+            self.assertEqual(TTLValue(self.loader, ttl=10, snapshot_file=path).get(), 7)
+
+
+class LRUCacheTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        for name in ('monotonic', 'time'):
+            patcher = patch(f'salsa.cache.{name}', self.clock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_expired_entries_kept_for_get_stale(self):
+        cache = LRUCache(max_entries=10, ttl=10)
+        cache.put('a', 1)
+        self.clock.now += 5
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.age('a'), 5)
+        self.clock.now += 5
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_stale('a'), 1)
+        self.assertIsNone(cache.get_stale('b'))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2, ttl=10)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get_stale('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_version_changes_on_put_and_clear(self):
+        cache = LRUCache(max_entries=2, ttl=10)
+        version = cache.version
+        cache.put_many([('a', 1), ('b', 2)])
+        self.assertGreater(cache.version, version)
+        version = cache.version
+        cache.clear()
+        self.assertGreater(cache.version, version)
+        self.assertIsNone(cache.get('a'))
+
+    def test_snapshot_round_trip(self):
+        with TemporaryDirectory() as directory:
+            path = join(directory, 'cache.json')
+            cache = LRUCache(max_entries=10, ttl=10, snapshot_file=path,
+                             encode=lambda v: {'v': v}, decode=lambda v: v['v'])
+            cache.put(('2', 'A'), 'x')
+            cache.save(force=True)
+            loaded = LRUCache(max_entries=10, ttl=10, snapshot_file=path,
+                              encode=lambda v: {'v': v}, decode=lambda v: v['v'])
+            self.assertEqual(loaded.get(('2', 'A')), 'x')
+            self.clock.now += 10
+            self.assertIsNone(loaded.get(('2', 'A')))
+
+    def test_backend_shared_instead_of_snapshot(self):
+        patcher = patch('salsa.backend.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        backend = MemoryBackend()
+        with TemporaryDirectory() as directory:
+            path = join(directory, 'cache.json')
+            cache = LRUCache(max_entries=10, ttl=10, snapshot_file=path)
+            cache.put('a', 1)
+            cache.save(force=True)
+            caches = [LRUCache(max_entries=10, ttl=10, snapshot_file=path) for _ in range(2)]
+            for shared in caches:
+                shared.backend = backend
+            self.assertIsNone(caches[0].get('a'))
+            caches[0].put('b', 2)
+            self.assertEqual(caches[1].get('b'), 2)
+            self.assertIsNone(caches[1].get_stale('a'))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from salsa.schedule import Schedule
+from salsa.intervals import OutageIndex
+
+
+class OutageIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = OutageIndex({'1A': Schedule([(0, 100, 1), (500, 600, 2)]),
+                                  '2B': Schedule([(50, 400, 3)]),
+                                  '3C': Schedule()})
+
+    def test_between_returns_overlapping_slots(self):
+        self.assertEqual(sorted(self.index.between(90, 120)), [('1A', 0, 100), ('2B', 50, 400)])
+        self.assertEqual(self.index.between(400, 499), [])
+        self.assertEqual(self.index.between(600, 700), [])
+        self.assertEqual(self.index.between(700, 800), [])
+
+    def test_between_finds_long_slot_started_before_window(self):
+        self.assertEqual(self.index.between(350, 360), [('2B', 50, 400)])
+
+    def test_at(self):
+        self.assertEqual(self.index.at(550), [('1A', 500, 600)])
+
+    def test_next_per_block(self):
+        self.assertEqual(self.index.next(150, ['1A', '2B', '3C', '9Z']),
+                         {'1A': (500, 600), '2B': (50, 400), '3C': None, '9Z': None})
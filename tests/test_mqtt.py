@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, skipIf
+
+try:
+    from service.mqtt import Notifier, on_connect
+except ImportError:
+    Notifier = None
+
+
+class MessageInfo(object):
+
+    def __init__(self, mid: int, rc: int = 0):
+        self.mid = mid
+        self.rc = rc
+
+
+class RecordingClient(object):
+    """ Client double recording publishes, acknowledged by ack, publishes fail while rc is set. """
+
+    def __init__(self, ack_immediately: bool = False):
+        self.published = []
+        self.subscribed = []
+        self.on_publish = None
+        self.on_message = None
+        self.ack_immediately = ack_immediately
+        self.rc = 0
+        self._mid = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._mid += 1
+        self.published.append((topic, payload, qos, retain))
+        if self.ack_immediately and not self.rc:
+            self.on_publish(self, None, self._mid)
+        return MessageInfo(self._mid, self.rc)
+
+    def subscribe(self, topic):
+        self.subscribed.append(topic)
+
+    def ack(self, mid: int):
+        self.on_publish(self, None, mid)
+
+
+def config(values: dict):
+    def get(*keys):
+        value = values
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+    return get
+
+
+@skipIf(Notifier is None, 'paho-mqtt is not installed')
+class NotifierTest(TestCase):
+
+    def setUp(self):
+        self.client = RecordingClient()
+        self.notifier = Notifier(self.client, config({'mqtt': {'max_in_flight': 2}}))
+
+    def topics(self) -> [str]:
+        return [p[0] for p in self.client.published]
+
+    def test_dedupes_state_topics_unless_forced(self):
+        self.client.ack_immediately = True
+        self.assertTrue(self.notifier.publish('ls/stage', 2))
+        self.assertFalse(self.notifier.publish('ls/stage', 2))
+        self.assertTrue(self.notifier.publish('ls/stage', 2, force=True))
+        self.assertTrue(self.notifier.publish('ls/stage', 3))
+        self.assertEqual(len(self.client.published), 3)
+
+    def test_alerts_not_deduped(self):
+        self.notifier.publish('ls/alert', 'on')
+        self.notifier.publish('ls/alert', 'on')
+        self.assertEqual(self.topics(), ['ls/alert', 'ls/alert'])
+
+    def test_reset_forgets_last_payloads(self):
+        self.notifier.publish('ls/schedule', 'x')
+        self.notifier.reset()
+        self.assertTrue(self.notifier.publish('ls/schedule', 'x'))
+
+    def test_topic_options_from_config(self):
+        notifier = Notifier(self.client, config({'mqtt': {'topics': {'alert': {'qos': 1, 'retain': False}}}}))
+        self.assertEqual(notifier.options('ls/1A/alert'), {'qos': 1, 'retain': False, 'dedupe': False})
+        self.assertEqual(notifier.options('ls/unknown'), {'qos': 0, 'retain': True, 'dedupe': False})
+
+    def test_in_flight_limit_queues_latest_payload_per_topic(self):
+        for i in range(2):
+            self.notifier.publish(f'ls/{i}/alert', 'on')
+        self.notifier.publish('ls/a/alert', 'first')
+        self.notifier.publish('ls/b/alert', 'on')
+        self.notifier.publish('ls/a/alert', 'second')
+        self.assertEqual((self.notifier.in_flight, self.notifier.pending), (2, 2))
+        self.client.ack(1)
+        self.client.ack(2)
+        self.assertEqual(self.client.published[2:], [('ls/b/alert', 'on', 0, True),
+                                                     ('ls/a/alert', 'second', 0, True)])
+        self.client.ack(3)
+        self.client.ack(4)
+        self.assertEqual((self.notifier.in_flight, self.notifier.pending), (0, 0))
+
+    def test_acknowledged_before_publish_returned(self):
+        client = RecordingClient(ack_immediately=True)
+        notifier = Notifier(client, config({'mqtt': {'max_in_flight': 1}}))
+        for i in range(3):
+            notifier.publish('ls/alert', i)
+        self.assertEqual(len(client.published), 3)
+        self.assertEqual(notifier.in_flight, 0)
+
+    def test_batch_coalesces_per_topic(self):
+        with self.notifier.batch():
+            self.notifier.publish('ls/stage', 1)
+            self.notifier.publish('ls/stage', 2)
+            with self.notifier.batch():
+                self.notifier.publish('ls/1A/schedule', 'x')
+            self.assertEqual(self.client.published, [])
+        self.assertEqual(self.client.published, [('ls/stage', '2', 0, True), ('ls/1A/schedule', 'x', 0, True)])
+
+    def test_failed_publish_not_in_flight(self):
+        self.client.rc = 4
+        self.notifier.publish('ls/stage', 2)
+        self.notifier.publish('ls/1A/alert', 'on')
+        self.assertEqual(self.notifier.in_flight, 0)
+        self.client.rc = 0
+        self.assertTrue(self.notifier.publish('ls/stage', 2))
+        self.assertEqual(self.notifier.in_flight, 1)
+
+    def test_reconnect_forgets_in_flight_and_sends_pending(self):
+        for i in range(3):
+            self.notifier.publish(f'ls/{i}/alert', 'on')
+        self.assertEqual((self.notifier.in_flight, self.notifier.pending), (2, 1))
+        self.notifier.reset()
+        self.assertEqual((self.notifier.in_flight, self.notifier.pending), (1, 0))
+        self.assertEqual(self.topics(), ['ls/0/alert', 'ls/1/alert', 'ls/2/alert'])
+        # Acknowledgements of the previous connection are ignored
+        self.client.ack(1)
+        self.client.ack(3)
+        self.assertEqual(self.notifier.in_flight, 0)
+        for i in range(2):
+            self.notifier.publish(f'ls/{i}/alert', 'off')
+        self.assertEqual((self.notifier.in_flight, self.notifier.pending), (2, 0))
+
+    def test_on_connect_publishes_status_through_notifier(self):
+        for i in range(3):
+            self.notifier.publish(f'ls/{i}/alert', 'on')
+        self.notifier.publish('ls/stage', 2)
+        user_data = {'config': config({'mqtt': {'topic': 'ls'}}), 'notifier': self.notifier}
+        on_connect(self.client, user_data, {}, 0)
+        self.assertEqual(self.client.subscribed, ['ls/sync'])
+        self.assertEqual(self.client.published[2:], [('ls/2/alert', 'on', 0, True), ('ls/stage', '2', 0, True)])
+        self.assertEqual((self.notifier.in_flight, self.notifier.pending), (2, 1))
+        self.client.ack(3)
+        self.assertEqual(self.client.published[-1], ('ls/status', 'online', 0, False))
+        self.assertEqual(self.notifier.in_flight, 2)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from os.path import join
+from salsa.schedule import Schedule
+from salsa.rotation import Rotation, RotationTable
+
+PERIOD = 400
+
+
+def rotating(periods: int, offset: int = 1000) -> Schedule:
+    """ Two slots per period of PERIOD seconds. """
+    return Schedule((offset + p * PERIOD + start, offset + p * PERIOD + start + 50, i)
+                    for p in range(periods) for i, start in ((1, 0), (2, 120)))
+
+
+class RotationTest(TestCase):
+
+    def test_learns_shortest_period(self):
+        rotation = Rotation.learn(rotating(4))
+        self.assertEqual(rotation.period, PERIOD)
+        self.assertEqual(list(rotation.offsets), [0, 120])
+        self.assertEqual(list(rotation.durations), [50, 50])
+
+    def test_project_matches_schedule(self):
+        schedule = rotating(10)
+        rotation = Rotation.learn(rotating(4))
+        projected = rotation.project(schedule.starts[0], schedule.starts[-1])
+        self.assertEqual(list(projected.range(0, 10 ** 6)), list(schedule.range(0, 10 ** 6)))
+
+    def test_project_bounds_and_earlier_range(self):
+        rotation = Rotation.learn(rotating(4))
+        self.assertEqual(list(rotation.project(1000 - PERIOD, 1000 - PERIOD + 120).starts), [600, 720])
+        self.assertEqual(len(rotation.project(1001, 1119)), 0)
+
+    def test_sparse_schedule_not_learned(self):
+        self.assertIsNone(Rotation.learn(Schedule([(0, 10, 1), (100, 110, 2)])))
+        self.assertIsNone(Rotation.learn(rotating(1)))
+
+    def test_two_periods_required(self):
+        self.assertIsNone(Rotation.learn(rotating(2)))
+        self.assertIsNotNone(Rotation.learn(rotating(3)))
+
+    def test_irregular_schedule_not_learned(self):
+        schedule = Schedule([(0, 10, 1), (100, 110, 2), (250, 260, 3), (300, 310, 4), (460, 470, 5)])
+        self.assertIsNone(Rotation.learn(schedule))
+
+
+class RotationTableTest(TestCase):
+
+    def test_save_and_load(self):
+        table = RotationTable.learn([(2, '1A', rotating(4)), (2, '2B', Schedule())])
+        self.assertEqual(len(table), 1)
+        self.assertIsNone(table.project(2, '2B', 0, 10 ** 6))
+        with TemporaryDirectory() as directory:
+            path = join(directory, 'rotation.json')
+            table.save(path)
+            loaded = RotationTable.load(path)
+        self.assertEqual(loaded.created, table.created)
+        self.assertEqual(list(loaded.project(2, '1A', 0, 5000).starts), list(table.project(2, '1A', 0, 5000).starts))
+        self.assertEqual(set(loaded.project_all(0, 5000, stages=[2])), {(2, '1A')})
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import patch
+from types import SimpleNamespace
+from tempfile import TemporaryDirectory
+from os.path import join, isfile
+from datetime import datetime, timezone
+from threading import Lock
+from time import time
+from salsa import salsa
+from salsa.schedule import Schedule
+from salsa.rotation import RotationTable
+from tests.test_rotation import rotating
+
+FROM_DATE = datetime(2021, 1, 1, tzinfo=timezone.utc)
+START = int(FROM_DATE.timestamp())
+
+
+def get_block(name: str = None, block: str = None) -> str:
+    if block:
+        return block.upper()
+    if name == 'Rosebank':
+        return '4B'
+    raise ValueError(f'Suburb \'{name}\' not found')
+
+
+def record(id: int, sub_block: str) -> dict:
+    return {'ID': id, 'SubBlock': sub_block, 'EventDate': f'2021-01-01T{id:02}:00:00Z',
+            'EndDate': f'2021-01-01T{id:02}:30:00Z'}
+
+
+class FetchScheduleTest(TestCase):
+
+    def test_keeps_records_of_block_only(self):
+        # The upstream substringof filter for 1A also matches 11A and 21A
+        results = [record(1, '1A'), record(2, '11A'), record(3, '1A, 21A'), record(4, '21A;31A')]
+        urls = []
+
+        def http_get(url, parser, **kwargs):
+            urls.append(url)
+            return parser({'d': {'results': results}})
+
+        with patch.object(salsa, 'http_get', http_get):
+            schedule = salsa.fetch_schedule(2, '1A')
+        self.assertIn("substringof('1A',SubBlock)", urls[0])
+        self.assertEqual(list(schedule.ids), [1, 3])
+
+
+class UseRotationTest(TestCase):
+
+    def setUp(self):
+        self.schedules = {'1A': rotating(4), '2B': Schedule()}
+        self.learned = 0
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = join(directory.name, 'rotation.json')
+        for name, replacement in (('suburb_index', SimpleNamespace(blocks=['1A', '2B'])),
+                                  ('_warm_cache', lambda stage, blocks: None),
+                                  ('_fetched_schedule', self.fetched_schedule),
+                                  ('rotation_table', None)):
+            patcher = patch.object(salsa, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fetched_schedule(self, stage: int, block: str) -> Schedule:
+        if stage != 2:
+            return Schedule()
+        self.learned += block == '1A'
+        return self.schedules[block]
+
+    def test_learned_and_saved_if_missing(self):
+        salsa.use_rotation(self.path)
+        self.assertEqual(set(salsa.rotation_table.rotations), {(2, '1A')})
+        self.assertTrue(isfile(self.path))
+        salsa.use_rotation(self.path)
+        self.assertEqual(self.learned, 1)
+
+    def test_empty_table_not_saved(self):
+        self.schedules['1A'] = Schedule()
+        self.assertEqual(len(salsa.learn_rotation(self.path, [2])), 0)
+        self.assertFalse(isfile(self.path))
+
+    def test_empty_or_outdated_table_learned_again(self):
+        rotations = RotationTable.learn([(2, '1A', rotating(4))]).rotations
+        for name, table, learned in (('empty', RotationTable({}), 1),
+                                     ('current', RotationTable(rotations), 0),
+                                     ('outdated', RotationTable(rotations, time() - 32 * 24 * 3600), 1)):
+            with self.subTest(name):
+                table.save(self.path)
+                self.learned = 0
+                salsa.use_rotation(self.path)
+                self.assertEqual(self.learned, learned)
+                self.assertEqual(set(salsa.rotation_table.rotations), {(2, '1A')})
+
+    def test_outdated_table_kept_if_none_learned(self):
+        self.schedules['1A'] = Schedule()
+        table = RotationTable.learn([(2, '1A', rotating(4))])
+        table.created -= 32 * 24 * 3600
+        table.save(self.path)
+        salsa.use_rotation(self.path)
+        self.assertEqual(salsa.rotation_table.created, table.created)
+
+
+class GetSchedulesTest(TestCase):
+
+    def setUp(self):
+        self.loads = []
+        self.warmed = []
+        self.lock = Lock()
+        for name, replacement in (('get_block', get_block),
+                                  ('get_full_schedule', self.get_full_schedule),
+                                  ('warm_schedules', lambda stage, blocks: self.warmed.append((stage, sorted(blocks)))),
+                                  ('get_schedule_age', lambda stage, block: 0),
+                                  ('rotation_table', None)):
+            patcher = patch.object(salsa, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_full_schedule(self, stage: int, block: str) -> Schedule:
+        with self.lock:
+            self.loads.append((stage, block))
+        if block == 'ERR':
+            raise RuntimeError('upstream failed')
+        return Schedule([(START + 3600 * stage, START + 3600 * stage + 1800, 1)])
+
+    def test_loads_each_stage_block_once(self):
+        results = salsa.get_schedules([{'stage': 2, 'block': '4b', 'days': 1},
+                                       {'stage': 2, 'name': 'Rosebank', 'days': 1},
+                                       {'stage': 3, 'block': '4B', 'days': 1}], from_date=FROM_DATE)
+        self.assertEqual(sorted(self.loads), [(2, '4B'), (3, '4B')])
+        self.assertEqual(sorted(self.warmed), [(2, ['4B']), (3, ['4B'])])
+        self.assertEqual([(r['stage'], r['block']) for r in results], [(2, '4B'), (2, '4B'), (3, '4B')])
+        self.assertEqual(results[0]['schedule'][0]['start'].timestamp(), START + 7200)
+
+    def test_errors_returned_per_item_in_query_order(self):
+        results = salsa.get_schedules([{'stage': 2, 'name': 'Nowhere'},
+                                       {'block': '4B'},
+                                       {'stage': 2},
+                                       'query',
+                                       {'stage': 2, 'block': 'ERR'},
+                                       {'stage': 2, 'block': '4B'}], from_date=FROM_DATE)
+        self.assertEqual([list(r) == ['error'] for r in results], [True, True, True, True, True, False])
+        self.assertIn('Nowhere', results[0]['error'])
+        self.assertEqual(results[4]['error'], 'upstream failed')
+        self.assertEqual(results[5]['block'], '4B')
+
+    def test_days_limit_schedule(self):
+        results = salsa.get_schedules([{'stage': 2, 'block': '4B', 'days': 0}], from_date=FROM_DATE)
+        self.assertEqual(results[0]['schedule'], [])
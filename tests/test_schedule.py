@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from salsa.schedule import Schedule, parse_timestamp
+
+
+class ScheduleTest(TestCase):
+
+    def setUp(self):
+        self.schedule = Schedule([(300, 400, 3), (100, 200, 1), (200, 250, 2)])
+
+    def test_slots_sorted_by_start(self):
+        self.assertEqual(list(self.schedule.starts), [100, 200, 300])
+        self.assertEqual(list(self.schedule.ids), [1, 2, 3])
+
+    def test_range_includes_bounds(self):
+        self.assertEqual(list(self.schedule.range(200, 300)), [(200, 250, 2), (300, 400, 3)])
+        self.assertEqual(list(self.schedule.range(201, 299)), [])
+        self.assertEqual(list(Schedule().range(0, 1000)), [])
+
+    def test_next_returns_ongoing_or_upcoming_slot(self):
+        self.assertEqual(self.schedule.next(0), (100, 200, 1))
+        self.assertEqual(self.schedule.next(150), (100, 200, 1))
+        self.assertEqual(self.schedule.next(250), (300, 400, 3))
+        self.assertIsNone(self.schedule.next(400))
+
+    def test_json_round_trip(self):
+        loaded = Schedule.from_json(self.schedule.to_json())
+        self.assertEqual(list(loaded.range(0, 1000)), list(self.schedule.range(0, 1000)))
+
+    def test_parse_timestamp_is_utc(self):
+        self.assertEqual(parse_timestamp('1970-01-02T00:00:10Z'), 86410)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from salsa.search import SearchIndex, normalize
+
+SUBURBS = [{'title': title, 'block': block, 'id': i}
+           for i, (title, block) in enumerate([('Rosebank', '4B'), ('Rosebank Ext 1', '4B'), ('Roseacres', '7A'),
+                                               ('Melrose', '2A'), ('Melrose North', '2A'), ('Parktown', '3C'),
+                                               ('Parkhurst', '3A'), ('Sandton', '1A')])]
+
+
+class SearchIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex(SUBURBS)
+
+    def titles(self, query: str, **kwargs) -> [str]:
+        return [s['title'] for s in self.index.suggest(query, **kwargs)]
+
+    def test_normalize(self):
+        self.assertEqual(normalize('  Rosebank-Ext.1 '), 'rosebank ext 1')
+
+    def test_exact_match_first(self):
+        result = self.index.suggest('rosebank')
+        self.assertEqual(result[0]['title'], 'Rosebank')
+        self.assertEqual(result[0]['score'], 1.0)
+        self.assertEqual(result[1]['title'], 'Rosebank Ext 1')
+
+    def test_prefix_before_substring(self):
+        self.assertEqual(self.titles('rose')[:3], ['Rosebank', 'Roseacres', 'Rosebank Ext 1'])
+        self.assertLess(self.titles('rose').index('Rosebank Ext 1'), self.titles('rose').index('Melrose'))
+
+    def test_prefix_ending_mid_word(self):
+        self.assertEqual(self.titles('park'), ['Parktown', 'Parkhurst'])
+
+    def test_tolerates_typos(self):
+        self.assertEqual(self.titles('roseback')[0], 'Rosebank')
+        self.assertEqual(self.titles('sandtn')[0], 'Sandton')
+
+    def test_limit_and_min_score(self):
+        self.assertEqual(len(self.index.suggest('rose', limit=2)), 2)
+        self.assertEqual(self.index.suggest('xyz'), [])
+        self.assertEqual(self.index.suggest(''), [])
+        self.assertEqual(self.index.suggest('rose', limit=0), [])
+
+    def test_results_keep_suburb_fields(self):
+        self.assertEqual({k: v for k, v in self.index.suggest('sandton')[0].items() if k != 'score'}, SUBURBS[7])
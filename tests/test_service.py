@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from http.client import HTTPConnection
+from threading import Timer
+from datetime import datetime, timezone
+from json import dumps, loads
+import gzip
+
+try:
+    import cherrypy
+    from salsa import salsa
+    from service import service
+    from service.events import broadcaster
+except ImportError:
+    cherrypy = None
+
+
+def config(*keys):
+    return None
+
+
+app = None
+
+
+def setUpModule():
+    global app
+    if cherrypy is None:
+        return
+    app, app_config = service.create_app(config)
+    cherrypy.tree.mount(app, '/', app_config)
+    cherrypy.config.update({'log.screen': False,
+                            'checker.on': False,
+                            'engine.autoreload.on': False,
+                            'server.socket_host': '127.0.0.1',
+                            'server.socket_port': 0})
+    cherrypy.engine.start()
+
+
+def tearDownModule():
+    if cherrypy is not None:
+        cherrypy.engine.exit()
+
+
+class ServiceTestCase(TestCase):
+
+    def request(self, path: str, method: str = 'GET', body: bytes = None, headers: dict = None):
+        """ Status, headers and body of a request to the test server. """
+        connection = HTTPConnection(*cherrypy.server.bound_addr, timeout=10)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            connection.close()
+
+    def patch(self, name: str, replacement):
+        patcher = patch.object(salsa, name, replacement)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+@skipIf(cherrypy is None, 'CherryPy is not installed')
+class ServeTest(ServiceTestCase):
+
+    def test_not_modified_on_matching_etag(self):
+        self.patch('get_stage', lambda: 2)
+        self.patch('get_stage_age', lambda: 0)
+        status, headers, body = self.request('/api/stage')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        status, _, body = self.request('/api/stage', headers={'If-None-Match': headers['ETag']})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+    def test_stage_max_age_is_remaining_ttl(self):
+        self.patch('get_stage', lambda: 2)
+        ttl = int(salsa.stage_cache.ttl)
+        for age, max_age in ((0, ttl), (ttl // 2, ttl - ttl // 2), (None, 0)):
+            with self.subTest(age=age):
+                self.patch('get_stage_age', lambda: age)
+                _, headers, _ = self.request('/api/stage')
+                self.assertEqual(headers['Cache-Control'], f'public, max-age={max_age}')
+
+    def test_large_payloads_gzipped_if_accepted(self):
+        suburbs = [{'name': f'Suburb {i}', 'block': f'{i % 16 + 1}A'} for i in range(100)]
+        self.patch('get_suburbs', lambda: suburbs)
+        _, plain_headers, plain = self.request('/api/list')
+        status, headers, body = self.request('/api/list', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertIsNone(plain_headers['Content-Encoding'])
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), plain)
+        self.assertEqual(headers['ETag'], f'{plain_headers["ETag"][:-1]}-gzip"')
+        status, _, _ = self.request('/api/list', headers={'Accept-Encoding': 'gzip',
+                                                          'If-None-Match': headers['ETag']})
+        self.assertEqual(status, 304)
+
+    def test_small_payloads_not_gzipped(self):
+        self.patch('get_stage', lambda: 2)
+        self.patch('get_stage_age', lambda: 0)
+        _, headers, _ = self.request('/api/stage', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(headers['Content-Encoding'])
+
+
+@skipIf(cherrypy is None, 'CherryPy is not installed')
+class EventsTest(ServiceTestCase):
+
+    def setUp(self):
+        patcher = patch.object(service, 'EVENTS_HEARTBEAT', 0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+        # Closed streams end at their next heartbeat
+        streams = app.api.events._streams
+        acquired = [streams.acquire(timeout=5) for _ in range(app.api.events.max_streams)]
+        for _ in filter(None, acquired):
+            streams.release()
+
+    def poll(self, query: str = '') -> dict:
+        status, _, body = self.request(f'/api/events{query}')
+        self.assertEqual(status, 200)
+        return loads(body)
+
+    def open_stream(self, headers: dict = None):
+        connection = HTTPConnection(*cherrypy.server.bound_addr, timeout=10)
+        self.connections.append(connection)
+        connection.request('GET', '/api/events', headers={'Accept': 'text/event-stream', **(headers or {})})
+        return connection.getresponse()
+
+    def read_event(self, response) -> dict:
+        """ Next event of a stream, skipping keepalive comments. """
+        while line := response.readline().decode('utf-8'):
+            if line.startswith('data: '):
+                return loads(line[6:])
+
+    def test_long_poll_returns_retained_and_new_events(self):
+        broadcaster.publish('salsa/stage', '{"stage": 2}')
+        retained = self.poll()
+        self.assertIn({'stage': 2}, [e['data'] for e in retained['events'] if e['topic'] == 'salsa/stage'])
+        Timer(0.1, broadcaster.publish, ('salsa/alert', '{"block": "1A"}')).start()
+        polled = self.poll(f'?since={retained["last_id"]}&timeout=5')
+        self.assertEqual([e['data'] for e in polled['events']], [{'block': '1A'}])
+        self.assertEqual(polled['last_id'], polled['events'][-1]['id'])
+
+    def test_long_poll_times_out_without_events(self):
+        _, last_id = broadcaster.retained()
+        self.assertEqual(self.poll(f'?since={last_id}&timeout=0.1'), {'last_id': last_id, 'events': []})
+
+    def test_bad_since_or_timeout(self):
+        for query in ('?since=abc', '?since=1&timeout=soon'):
+            with self.subTest(query=query):
+                status, _, _ = self.request(f'/api/events{query}')
+                self.assertEqual(status, 400)
+
+    def test_stream_resumes_after_last_event_id(self):
+        broadcaster.publish('salsa/stage', '{"stage": 3}')
+        _, last_id = broadcaster.retained()
+        response = self.open_stream({'Last-Event-ID': str(last_id)})
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/event-stream'))
+        broadcaster.publish('salsa/stage', '{"stage": 4}')
+        event = self.read_event(response)
+        self.assertEqual((event['id'], event['data']), (last_id + 1, {'stage': 4}))
+
+    def test_stream_with_bad_last_event_id_starts_with_retained_events(self):
+        broadcaster.publish('salsa/stage', '{"stage": 5}')
+        response = self.open_stream({'Last-Event-ID': 'abc'})
+        self.assertEqual(response.status, 200)
+        events = [self.read_event(response) for _ in range(len(broadcaster.retained()[0]))]
+        self.assertIn({'stage': 5}, [e['data'] for e in events])
+
+    def test_streams_capped(self):
+        streams = [self.open_stream() for _ in range(2)]
+        self.assertEqual([s.status for s in streams], [200, 200])
+        status, headers, _ = self.request('/api/events', headers={'Accept': 'text/event-stream'})
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['Retry-After'], str(service.EVENTS_RETRY_AFTER))
+
+
+@skipIf(cherrypy is None, 'CherryPy is not installed')
+class ScheduleBatchTest(ServiceTestCase):
+
+    def setUp(self):
+        start = datetime(2021, 1, 1, 2, tzinfo=timezone.utc)
+        self.patch('get_schedules', lambda queries: [
+            {'stage': q['stage'], 'block': q['block'], 'schedule': [{'start': start, 'end': start}]}
+            if 'block' in q else {'error': 'No block'} for q in queries])
+
+    def post(self, queries) -> tuple:
+        return self.request('/api/schedule/batch', 'POST', dumps(queries).encode('utf-8'),
+                            {'Content-Type': 'application/json'})
+
+    def test_results_in_query_order_and_not_cached(self):
+        status, headers, body = self.post([{'stage': 2, 'block': '1A'}, {'stage': 2}])
+        self.assertEqual(status, 200)
+        self.assertEqual(loads(body), {'results': [
+            {'stage': 2, 'suburb': None, 'block': '1A',
+             'schedule': [{'start': '2021-01-01T02:00:00+00:00', 'end': '2021-01-01T02:00:00+00:00'}]},
+            {'error': 'No block'}]})
+        self.assertEqual(headers['Cache-Control'], 'no-store')
+        self.assertIsNone(headers['ETag'])
+
+    def test_queries_object(self):
+        _, _, body = self.post({'queries': [{'stage': 3, 'block': '2B'}]})
+        self.assertEqual(loads(body)['results'][0]['block'], '2B')
+
+    def test_bad_requests(self):
+        for queries, status in (({'stage': 2}, 400),
+                                ([{'stage': 2, 'block': '1A'}] * (service.SCHEDULE_BATCH_MAX + 1), 413)):
+            with self.subTest(status=status):
+                self.assertEqual(self.post(queries)[0], status)